@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+"""benchmarks.py - a module for measuring the speed of reading the logs
+
+The benchmarks are run on a log generated with generate_log(), and they
+print how many lines or items per second the old and the new way of doing
+something can handle.
+
+Usage:
+benchmarks.py [lines [benchmark...]]
+
+Example usage:
+from benchmarks import generate_log, benchmark_timestamps
+generate_log("/tmp/test.log", 100000)
+benchmark_timestamps("/tmp/test.log")
+"""
+
+from __future__ import with_statement
+
+import sys, os, re, time, random, datetime, tempfile, mmap
+from cStringIO import StringIO
+
+from channellog import parse_logline
+
+def generate_log(logname, lines, seed=1):
+    """Writes a log of random but plausible activity on a few channels"""
+    rand = random.Random(seed)
+    channels = ["#sioc", "#swig", "#foaf"]
+    nicks = ["alice", "bob", "carol", "dave", "eve", "frank", "gina"]
+    messages = ["hello", "see http://example.org/a,b.", "[off] secret",
+                "(www.example.com/foo), ok", "\x01ACTION waves\x01"]
+    t = datetime.datetime(2009, 8, 30, 20, 0, 0)
+    with file(logname, "w") as f:
+        for i in xrange(lines):
+            t += datetime.timedelta(seconds=rand.randint(0, 20))
+            timestamp = t.strftime("%Y-%m-%dT%H:%M:%S+03:00")
+            nick = rand.choice(nicks)
+            channel = rand.choice(channels)
+            r = rand.random()
+            if r < 0.8:
+                line = ":%s!u@h PRIVMSG %s :%s" % (nick, channel,
+                                                  rand.choice(messages))
+            elif r < 0.9:
+                line = ":%s!u@h JOIN %s" % (nick, channel)
+            else:
+                line = ":%s!u@h PART %s :bye" % (nick, channel)
+            f.write("%s %s\r\n" % (timestamp, line))
+
+def measure(name, function, items):
+    """Runs the function on the items and prints the items per second"""
+    start = time.time()
+    for item in items:
+        function(item)
+    report(name, len(items), time.time() - start)
+
+def report(name, count, seconds):
+    print "%-45s %10.0f/s" % (name, count / max(seconds, 1e-9))
+
+def benchmark_timestamps(logname):
+    """The conversion of the timestamps of the lines into UTC"""
+    import ircbase
+    with file(logname) as f:
+        timestamps = [parse_logline(l).time for l in f]
+    measure("parse_timestamp_to_z (before)",
+            ircbase.parse_timestamp_to_z, timestamps)
+    ircbase.hour_cache.clear()
+    measure("convert_timestamp_to_z (after)",
+            ircbase.convert_timestamp_to_z, timestamps)
+
+def getattr_dispatch(self, line):
+    """Irc.handleReceived as it was before the dispatch tables"""
+    from twisted.words.protocols import irc
+    name = irc.numeric_to_symbolic.get(line.cmd, line.cmd)
+    method = getattr(self, "irc_%s" % name, None)
+    if method == None or not method(line):
+        self.handleReceivedFallback(line)
+
+def page_pipelines():
+    """Yields the names of the pipelines of the usual pages and functions
+    that create them"""
+    from channellog import AddRegisteredFilter, OffFilter, ChannelFilter, \
+        TimeFilter, AddLinksFilter, EventSink, ChannelsAndDaysSink
+    def channel_day():
+        sink = EventSink("http://example.org/", "sioc", "2009-09-01",
+                         "http://example.org/sioc/2009-09-01")
+        return AddRegisteredFilter(OffFilter(ChannelFilter("#sioc",
+                   TimeFilter("2009-09-01", AddLinksFilter(sink)))))
+    def channels_and_days():
+        return AddRegisteredFilter(ChannelsAndDaysSink())
+    yield "channel day", channel_day
+    yield "channels and days", channels_and_days
+
+def parsed_lines(logname):
+    """Returns the lines of a log parsed, as the pipelines would see them"""
+    with file(logname) as f:
+        lines = [parse_logline(l) for l in f]
+    for line in lines:
+        line.cmd, line.ztime # parse now
+    return lines
+
+def benchmark_dispatch(logname):
+    """The dispatch of the lines to the irc_CMD methods of the stages"""
+    from ircbase import Irc
+    handleReceived = Irc.handleReceived.im_func
+    for name, create_pipeline in page_pipelines():
+        Irc.handleReceived = getattr_dispatch
+        try:
+            measure("%s, getattr (before)" % name,
+                    create_pipeline().handleReceived, parsed_lines(logname))
+        finally:
+            Irc.handleReceived = handleReceived
+        measure("%s, dispatch tables (after)" % name,
+                create_pipeline().handleReceived, parsed_lines(logname))
+
+def readline_range(source, start, end):
+    """read_range as it was before reading by iteration"""
+    source.seek(start)
+    pos = start
+    while end is None or pos < end:
+        l = source.readline()
+        if not l:
+            break
+        pos += len(l)
+        yield l
+
+def mmap_range(source, start, end):
+    """read_range from a memory map of the file, which isn't faster, as the
+    lines are copied out of the map anyway, and Python 2 can't give the
+    kernel hints for reading ahead"""
+    size = os.fstat(source.fileno()).st_size
+    if size == 0:
+        return
+    m = mmap.mmap(source.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        pos = start
+        if end is None or end > size:
+            end = size
+        while pos < end:
+            newline = m.find("\n", pos)
+            if newline == -1: # the last line is still being written
+                yield m[pos:]
+                break
+            yield m[pos:newline+1]
+            pos = newline + 1
+    finally:
+        m.close()
+
+def benchmark_reading(logname):
+    """The reading of the lines of a log file"""
+    from channellog import read_range
+    for name, reader in [("readline (before)", readline_range),
+                         ("read_range (after)", read_range),
+                         ("mmap_range", mmap_range)]:
+        with file(logname) as f:
+            start = time.time()
+            count = 0
+            for l in reader(f, 0, None):
+                count += 1
+            report(name, count, time.time() - start)
+
+def benchmark_segments(logname):
+    """The reading of the lines of a log stored compressed"""
+    import gzip, logsegments
+    from logsegments import open_log, convert_log
+    with file(logname) as source:
+        with gzip.open(logname + ".gz", "wb") as f:
+            f.writelines(source)
+    convert_log(logname)
+    convert_log(logname, logsegments.CompactWriter, logsegments.COMPACT_SUFFIX)
+    try:
+        for suffix in ["", ".gz", logsegments.BLOCKS_SUFFIX,
+                       logsegments.COMPACT_SUFFIX]:
+            size = os.path.getsize(logname + suffix)
+            with open_log(logname + suffix) as f:
+                start = time.time()
+                count = 0
+                for l in f:
+                    count += 1
+                report("%s (%d bytes)" % (suffix or "plain", size), count,
+                       time.time() - start)
+    finally:
+        for suffix in [".gz", logsegments.BLOCKS_SUFFIX,
+                       logsegments.COMPACT_SUFFIX]:
+            os.remove(logname + suffix)
+
+def list_tail_privmsg(self, line):
+    """ChannelMessageTailFilter.irc_PRIVMSG as it was before the deques"""
+    channel = line.args[0]
+    if not channel.startswith("#"):
+        return True
+    self.channels[channel] = ([(self.count, line)] +
+                              self.channels.get(channel, [])[:self.n-1])
+    self.count += 1
+    return True
+
+def list_tail_close(self):
+    """ChannelMessageTailFilter.close as it was before the deques"""
+    events = sum(self.channels.values(), [])
+    events.sort()
+    for _,line in events:
+        self.sink.handleReceived(line)
+
+def benchmark_tail(logname):
+    """The keeping of the last messages of each channel"""
+    from channellog import ChannelMessageTailFilter, IrcSink
+    lines = parsed_lines(logname)
+    for n in [1, 100]:
+        for name, privmsg, close in [
+                ("lists (before)", list_tail_privmsg, list_tail_close),
+                ("deques (after)", ChannelMessageTailFilter.irc_PRIVMSG.im_func,
+                 ChannelMessageTailFilter.close.im_func)]:
+            class Filter(ChannelMessageTailFilter):
+                pass
+            Filter.irc_PRIVMSG, Filter.close = privmsg, close
+            tail = Filter(n, IrcSink())
+            start = time.time()
+            for line in lines:
+                tail.handleReceived(line)
+            tail.close()
+            report("last %d, %s" % (n, name), len(lines), time.time() - start)
+
+# AddLinksFilter's regular expressions before the single pass:
+regex_link_res = [(re.compile(link_re), sub) for (link_re, sub) in [
+    (r'&lt;(http(s)?://[^ ]*)&gt;', r'&lt;<a href="\1">\1</a>&gt;'),
+    (r'&quot;(http(s)?://[^ ]*)&quot;', r'&quot;<a href="\1">\1</a>&quot;'),
+    (r'\[(http(s)?://[^ |]*)(\||\])', r'[<a href="\1">\1</a>\3'),
+    (r'(http(s)?://[^ ]*[^ ,.\1])[)](,? |$)', r'<a href="\1">\1</a>)\3'),
+    (r'(http(s)?://[^ ]*[^ ,.\1])', r'<a href="\1">\1</a>'),
+    (r'(^|[ (])(www\.[^ ]*[^ ,.\1])[)](,? |$)',
+     r'\1<a href="http://\2">\2</a>)\3'),
+    (r'(^|[ (])(www\.[^ ]*[^ ,.\1])', r'\1<a href="http://\2">\2</a>')]]
+
+def regex_add_links(content_html):
+    """add_links as it was before the single pass, in AddLinksFilter"""
+    from htmlutil import html_unescape
+    links = []
+    for link_re, sub in regex_link_res:
+        content_html_sub = link_re.sub(sub, content_html)
+        if content_html_sub is not content_html:
+            for groups in link_re.findall(content_html):
+                if groups[1].startswith("www"):
+                    uri = "http://" + groups[1]
+                else:
+                    uri = groups[0]
+                links += [html_unescape(uri)]
+            break
+    return content_html_sub, links
+
+def link_messages(count, seed=1):
+    """Returns messages with links of the different forms, as on the
+    channels where links are often shared"""
+    rand = random.Random(seed)
+    words = ["see", "the", "spec", "at", "ok,", "http://example.org/a,b.",
+             "(www.example.com/foo),", "<http://x.org/q?a=1&b=2>",
+             '"https://y.org/z"', "[http://w.org|label]",
+             "(http://p.org/x)", "www.baz.org", "http://q.org/"]
+    return [" ".join(rand.choice(words) for i in xrange(rand.randint(1, 12)))
+            for i in xrange(count)]
+
+def benchmark_links(logname):
+    """The making of the links in the messages into anchors"""
+    from htmlutil import html_escape
+    from channellog import add_links
+    messages = [html_escape(m) for m in link_messages(100000)]
+    measure("regular expressions in turn (before)", regex_add_links,
+            messages)
+    measure("single pass (after)", add_links, messages)
+    more = sum(1 for m in messages
+               if len(add_links(m)[1]) > len(regex_add_links(m)[1]))
+    print "%d of %d messages have links that were missed before" % (
+        more, len(messages))
+
+def replace_turtle_escape(self, endchar, text):
+    """TurtleWriter.turtle_escape as it was before the escape table"""
+    replacements = ([('\\', '\\\\'),
+                     (endchar, '\\'+endchar),
+                     ('\n', '\\n'),
+                     ('\r', '\\r'),
+                     ('\t', '\\t')] +
+                    [(chr(c), '\\u%04x' % c) for c in range(0x20)+[0x7f]]
+                    )
+    for char, escape in replacements:
+        text = text.replace(char, escape)
+    return text
+
+def loop_show_uri(self, node):
+    """TurtleWriter.show for URIs as it was before the cache"""
+    if self.base and node.startswith(self.base):
+        rest = node[len(self.base):]
+        if self.base.endswith("/") and not rest.startswith("/"):
+            return "<" + self.turtle_escape(">", rest) + ">"
+    for ns, uri in self.namespaces:
+        if node.startswith(uri):
+            return ns + ":" + node[len(uri):]
+    return "<" + self.turtle_escape(">", node) + ">"
+
+def benchmark_turtle(logname):
+    """The writing of a Turtle document of 100k triples"""
+    from turtle import TurtleWriter
+    from vocabulary import namespaces
+    from channellog import TurtleSink, add_links
+    from htmlutil import html_escape
+    sink = TurtleSink("http://example.org/", "#sioc", "2009")
+    triples = []
+    for line in parsed_lines(logname):
+        if len(triples) >= 100000:
+            break
+        if line.cmd == "PRIVMSG":
+            line.links = add_links(html_escape(line.args[1]))[1]
+            triples += sink.create_triples(line)
+    class BeforeWriter(TurtleWriter):
+        turtle_escape = replace_turtle_escape
+        def show(self, node):
+            if isinstance(node, basestring):
+                return loop_show_uri(self, node)
+            return TurtleWriter.show(self, node)
+    stdout = sys.stdout
+    for name, writerclass, grouped in [
+            ("replace and loop (before)", BeforeWriter, False),
+            ("table and cache (after)", TurtleWriter, False),
+            ("grouped", TurtleWriter, True)]:
+        sys.stdout = StringIO()
+        try:
+            start = time.time()
+            writer = writerclass("http://example.org/", namespaces, grouped)
+            writer.write(triples)
+            writer.close()
+            seconds = time.time() - start
+            size = len(sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+        report("%s (%d bytes)" % (name, size), len(triples), seconds)
+
+BENCHMARKS = [benchmark_timestamps, benchmark_dispatch, benchmark_reading,
+              benchmark_segments, benchmark_tail, benchmark_links,
+              benchmark_turtle]
+
+if __name__ == '__main__':
+    lines = 100000
+    if len(sys.argv) > 1:
+        lines = int(sys.argv[1])
+    names = sys.argv[2:]
+
+    fd, logname = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        generate_log(logname, lines)
+        for benchmark in BENCHMARKS:
+            if names and benchmark.__name__ not in names:
+                continue
+            print "%s: %s" % (benchmark.__name__, benchmark.__doc__)
+            benchmark(logname)
+    finally:
+        os.remove(logname)
@@ -8,18 +8,24 @@ pipeline = ChannelFilter("#sioc", RawSink())
 run(file("sioc.log"), pipeline)
 """
 
-import sys, re
+from __future__ import with_statement
+
+import sys, os, re, datetime, multiprocessing, cPickle
+from collections import deque
 
 from traceback import print_exc
 
 import ircbase
 ircbase.dbg = False
-from ircbase import parseprefix, Line, Irc
+from ircbase import parseprefix, Irc, convert_timestamp_to_z
+from ircbase import irc_lower, Membership, LazyLine
 
 from templating import new_context, get_template, expand_template
 from turtle import PlainLiteral, TypedLiteral, TurtleWriter
 from vocabulary import namespaces, RDF, RDFS, OWL, DC, DCTERMS, XSD, FOAF, SIOC, SIOCT, DS
 from htmlutil import html_escape, html_unescape
+import logindex
+from logsegments import open_log, seekable, log_size
 
 
 def parse_action(text):
@@ -30,18 +36,74 @@ def parse_action(text):
 
 
 class IrcFilter(Irc):
+    # whether the lines dropped by the following stages don't affect this
+    # one, see pipeline_prefilter():
+    transparent = False
+
     def __init__(self, sink):
         self.sink = sink
 
+    def prefilter(self):
+        """Returns a function that tells from a line of a log file whether
+        this stage can pass it on or be affected by it, or None if it can
+        by any line"""
+        return None
+
+    def handleReceivedBatch(self, lines):
+        """Handles a list of lines, like handleReceived does one by one.
+        Stages can do this faster for the whole list at once."""
+        for line in lines:
+            self.handleReceived(line)
+
     def close(self):
         if self.sink:
             self.sink.close()
 
+    def merge(self, other):
+        """Adds the results of another pipeline like this one that has
+        handled the lines following the ones handled by this one"""
+        self.sink.merge(other.sink)
+
 class IrcSink(IrcFilter):
     def __init__(self):
         IrcFilter.__init__(self, None)
 
+    def merge(self, other):
+        raise TypeError("%s can't be merged" % self.__class__.__name__)
+
+class TeeFilter(IrcFilter):
+    """A filter that passes on each line to several sinks, so that one
+    reading of the logs can feed several pipelines. The sinks get the same
+    Line objects, so they shouldn't modify them in different ways."""
+    def __init__(self, sinks):
+        IrcFilter.__init__(self, None)
+        self.sinks = sinks
+
+    def handleReceived(self, line):
+        for sink in self.sinks:
+            sink.handleReceived(line)
+
+    def handleReceivedBatch(self, lines):
+        for sink in self.sinks:
+            sink.handleReceivedBatch(lines)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def merge(self, other):
+        for sink, othersink in zip(self.sinks, other.sinks):
+            sink.merge(othersink)
+
+    def prefilter(self):
+        predicates = [pipeline_prefilter(sink) for sink in self.sinks]
+        if None in predicates:
+            return None
+        return lambda l: any(p(l) for p in predicates)
+
 class AddRegisteredFilter(IrcFilter):
+    transparent = True
+
     def irc_PRIVMSG(self, line):
         content = line.args[1]
         if content[0] in ["+", "-"]:
@@ -55,39 +117,78 @@ class AddRegisteredFilter(IrcFilter):
     def handleReceivedFallback(self, line):
         self.sink.handleReceived(line)
 
+    def handleReceivedBatch(self, lines):
+        add_registered = self.irc_PRIVMSG
+        for line in lines:
+            if line.cmd == "PRIVMSG" or line.cmd == "NOTICE":
+                add_registered(line)
+        self.sink.handleReceivedBatch(lines)
 
+    # the same in FusedPipeline:
+    fused_code = """
+    if cmd == "PRIVMSG" or cmd == "NOTICE":
+        content = line.args[1]
+        if content[0] in ["+", "-"]:
+            line.registered = content[0]
+            line.args[1] = content[1:]
+        else:
+            line.registered = None"""
+
+
+# the forms of the links in the HTML-escaped messages, tried in this order
+# at each position of a message:
 link_res = [
-  (r'&lt;(http(s)?://[^ ]*)&gt;',         r'&lt;<a href="\1">\1</a>&gt;'),
-(r'&quot;(http(s)?://[^ ]*)&quot;',     r'&quot;<a href="\1">\1</a>&quot;'),
-    (r'\[(http(s)?://[^ |]*)(\||\])',        r'[<a href="\1">\1</a>\3'),
-(r'(http(s)?://[^ ]*[^ ,.\1])[)](,? |$)',     r'<a href="\1">\1</a>)\3'),
-(r'(http(s)?://[^ ]*[^ ,.\1])',               r'<a href="\1">\1</a>'),
-(r'(^|[ (])(www\.[^ ]*[^ ,.\1])[)](,? |$)', r'\1<a href="http://\2">\2</a>)\3'),
-(r'(^|[ (])(www\.[^ ]*[^ ,.\1])',           r'\1<a href="http://\2">\2</a>'),
+    r'&lt;(?P<angle>https?://[^ ]*)&gt;',
+    r'&quot;(?P<quoted>https?://[^ ]*)&quot;',
+    r'\[(?P<bracket>https?://[^ |]*)(?=\||\])',
+    r'(?P<paren>https?://[^ ]*[^ ,.\1])[)](?=,? |$)',
+    r'(?P<plain>https?://[^ ]*[^ ,.\1])',
+    r'(?:^|(?<=[ (]))(?P<wwwparen>www\.[^ ]*[^ ,.\1])[)](?=,? |$)',
+    r'(?:^|(?<=[ (]))(?P<www>www\.[^ ]*[^ ,.\1])',
 ]
-link_res = [(re.compile(link_re), sub) for (link_re, sub) in link_res]
+# (each form starts with one of the characters of the lookahead)
+link_re = re.compile(r"(?=[&\[hw])(?:%s)" % "|".join(link_res))
+# the text matched around the link of each form:
+link_templates = {'angle': '&lt;%s&gt;', 'quoted': '&quot;%s&quot;',
+                  'bracket': '[%s', 'paren': '%s)', 'plain': '%s',
+                  'wwwparen': '%s)', 'www': '%s'}
+
+def add_links(content_html):
+    """Returns the HTML-escaped message with its links made into anchors,
+    and the links, in one pass over it"""
+    links = []
+    def anchor(match):
+        form = match.lastgroup
+        text = match.group(form)
+        if form.startswith("www"):
+            uri = "http://" + text
+        else:
+            uri = text
+        links.append("&" in uri and html_unescape(uri) or uri)
+        return link_templates[form] % ('<a href="%s">%s</a>' % (uri, text))
+    return link_re.sub(anchor, content_html), links
+
 class AddLinksFilter(IrcFilter):
+    transparent = True
+
     def irc_PRIVMSG(self, line):
-        content = line.args[1]
-        content_html = html_escape(content)
-        links = []
-        for link_re, sub in link_res:
-            content_html_sub = link_re.sub(sub, content_html)
-            if content_html_sub is not content_html:
-                for groups in link_re.findall(content_html):
-                    if groups[1].startswith("www"):
-                        uri = "http://" + groups[1]
-                    else:
-                        uri = groups[0]
-                    links += [html_unescape(uri)]
-                break # XXX later link_res could match other parts of the string
-
-        line.content_html = content_html_sub
-        line.links = links
+        line.content_html, line.links = add_links(html_escape(line.args[1]))
 
     def handleReceivedFallback(self, line):
         self.sink.handleReceived(line)
 
+    def handleReceivedBatch(self, lines):
+        add_links = self.irc_PRIVMSG
+        for line in lines:
+            if line.cmd == "PRIVMSG":
+                add_links(line)
+        self.sink.handleReceivedBatch(lines)
+
+    # the same in FusedPipeline:
+    fused_code = """
+    if cmd == "PRIVMSG":
+        %(stage)s.irc_PRIVMSG(line)"""
+
 
 class ChannelFilter(IrcFilter):
     """A filter that only passes on lines related to a given channel"""
@@ -98,41 +199,63 @@ class ChannelFilter(IrcFilter):
         self.user = None # user@host
         self.serverprefix = None # irc.jyu.fi
         self.clientprefix = None # nick!user@host
-        self.channels = []
+        self.channels = set()
         self.away = False
         self.awaymsg = None
 
-        self.namreply = {}
-
-        self.interestingchannel = channel
+        self.interestingchannel = channel and irc_lower(channel)
         self.sink = sink
-        self.nick2channels = {}
-        self.channel2nicks = {}
+        self.members = Membership()
 
 
     def isme(self, prefix):
         return parseprefix(prefix)[0] == self.nick
 
     def handleReceived(self, line):
-        if line.prefix:
-            nick,_ = parseprefix(line.prefix)
-        else:
-            nick = None
-        relatedbefore = self.nick2channels.get(nick, [])
+        if self.interestingchannel in self.track(line):
+            self.sink.handleReceived(line)
+
+    def handleReceivedBatch(self, lines):
+        channel, track = self.interestingchannel, self.track
+        self.sink.handleReceivedBatch([line for line in lines
+                                       if channel in track(line)])
+
+    # the same in FusedPipeline:
+    fused_code = """
+    if %(stage)s.interestingchannel not in %(stage)s.track(line):
+        return"""
+
+    def merge(self, other):
+        raise TypeError("the channel state needs all the lines")
+
+    def prefilter(self):
+        if not self.interestingchannel:
+            return None
+        channel = self.interestingchannel
+        def accept(l):
+            # the lines of the channel, or about nicks on all channels:
+            l = irc_lower(l)
+            return (channel in l or " nick " in l or " quit " in l or
+                    " 001 " in l)
+        return accept
+
+    def track(self, line):
+        """Updates the channel state with a line and returns the channels
+        the line is related to"""
+        if line.cmd in ('NICK', 'QUIT'):
+            nick,_ = parseprefix(line.prefix or "")
+            relatedbefore = self.members.channels_of(nick or "")
+            Irc.handleReceived(self, line)
+            return relatedbefore
         Irc.handleReceived(self, line)
 # FIXME: Many commands missing here!
-        if line.cmd in ('NICK', 'QUIT'):
-            if self.interestingchannel in relatedbefore:
-                self.sink.handleReceived(line)
-        elif line.cmd in ('JOIN','PART','KICK','PRIVMSG','NOTICE','TOPIC'):
-            if line.args[0].lower() == self.interestingchannel:
-                self.sink.handleReceived(line)
+        if line.cmd in ('JOIN','PART','KICK','PRIVMSG','NOTICE','TOPIC'):
+            return [irc_lower(line.args[0])]
         elif line.cmd in ('366','332','333','329'):
-            if line.args[1].lower() == self.interestingchannel:
-                self.sink.handleReceived(line)
+            return [irc_lower(line.args[1])]
         elif line.cmd in ('353',):
-            if line.args[2].lower() == self.interestingchannel:
-                self.sink.handleReceived(line)
+            return [irc_lower(line.args[2])]
+        return []
     handleReceivedFallback = lambda self,x:None
 
 # state tracking:
@@ -144,14 +267,11 @@ class ChannelFilter(IrcFilter):
 
         # reset state from previous connects:
 
-        self.channels = []
+        self.channels = set()
         self.away = False
         self.awaymsg = None
 
-        self.namreply = {}
-
-        self.nick2channels = {}
-        self.channel2nicks = {}
+        self.members.clear()
 
     def irc_NICK(self, line):
         # we get messages about other clients as well
@@ -159,83 +279,156 @@ class ChannelFilter(IrcFilter):
             self.nick = line.args[0]
             self.clientprefix = self.nick + '!' + self.user
         oldnick,_ = parseprefix(line.prefix)
-        newnick = line.args[0]
-        self.nick2channels[newnick] = self.nick2channels[oldnick]
-        del self.nick2channels[oldnick]
-        for c in self.nick2channels[newnick]:
-            i = self.channel2nicks[c].index(oldnick)
-            self.channel2nicks[c][i] = newnick
-            
+        self.members.rename(oldnick, line.args[0])
+
     def irc_JOIN(self, line):
-        channel = line.args[0].lower()
+        channel = irc_lower(line.args[0])
         if self.isme(line.prefix):
-            self.channels.append(channel)
-            self.channel2nicks[channel] = [] 
+            self.channels.add(channel)
+            self.members.leave(channel)
         nick,_ = parseprefix(line.prefix)
-        if not nick in self.nick2channels:
-            self.nick2channels[nick] = []
-        self.nick2channels[nick].append(channel)
-        self.channel2nicks[channel].append(nick)
+        self.members.join(nick, channel)
+
     def irc_PART(self, line):
-        channel = line.args[0].lower()
+        channel = irc_lower(line.args[0])
         if self.isme(line.prefix):
-            self.channels.remove(channel)
-            del self.channel2nicks[channel]
+            self.leave(channel)
         else:
             nick,_ = parseprefix(line.prefix)
-            self.nick2channels[nick].remove(channel)
-            self.channel2nicks[channel].remove(nick)
+            self.members.part(nick, channel)
 
     def irc_KICK(self, line):
-        channel = line.args[0].lower()
-        if line.args[1] == self.nick:
-            self.channels.remove(channel)
-            del self.channel2nicks[channel]
+        channel = irc_lower(line.args[0])
+        if irc_lower(line.args[1]) == irc_lower(self.nick or ""):
+            self.leave(channel)
         else:
-            nickword = line.args[1].lower()
-            for n in self.nick2channels.keys():
-                if n.lower() == nickword:
-                    nick = n
-            self.nick2channels[nick].remove(channel)
-            self.channel2nicks[channel].remove(nick)
+            self.members.part(line.args[1], channel)
 
     def irc_QUIT(self, line):
         nick,_ = parseprefix(line.prefix)
-        for c in self.nick2channels[nick]:
-            self.channel2nicks[c].remove(nick)
-        del self.nick2channels[nick]
+        self.members.quit(nick)
+
+    def leave(self, channel):
+        self.channels.discard(channel)
+        self.members.leave(channel)
 
 #2008-09-25T18:32:40+03:00 :irc.jyu.fi 353 tuukkah_ = #footest :tuukkah_ @tuukkah
 #2008-09-25T18:32:40+03:00 :irc.jyu.fi 366 tuukkah_ #footest :End of NAMES list.
     def irc_RPL_NAMREPLY(self, line):
-        channel = line.args[2].lower()
-        if not channel in self.namreply:
-            self.namreply[channel] = []
-        self.namreply[channel] += line.args[3].split(" ")
+        self.members.names(line.args[2], line.args[3].split(" "))
 
     def irc_RPL_ENDOFNAMES(self, line):
-        channel = line.args[1].lower()
-        newnicks = self.namreply.pop(channel)
-        oldnicks = self.channel2nicks[channel]
-        for n in oldnicks:
-            self.nick2channels[n].remove(channel)
-        self.channel2nicks[channel] = []
-        for n in newnicks:
-            if not n:
-                continue
-            nick = n.lstrip("@").lstrip("+")
-            self.channel2nicks[channel].append(nick)
-            if not nick in self.nick2channels:
-                self.nick2channels[nick] = []
-            self.nick2channels[nick].append(channel)
+        self.members.end_names(line.args[1])
 
     def irc_RPL_UNAWAY(self, _):
         self.away = False
     def irc_RPL_NOWAWAY(self, _):
         self.away = True
 
+# snapshots of the state, see logindex.py:
+    def client_state(self):
+        return {'nick': self.nick, 'user': self.user,
+                'clientprefix': self.clientprefix,
+                'channels': sorted(self.channels)}
+
+    def channel_state(self, channel):
+        channel = irc_lower(channel)
+        if channel not in self.members.channels():
+            return None
+        return {'nicks': sorted(self.members.members(channel)),
+                'namreply': self.members.namreply.get(channel)}
+
+    def seed(self, clientstate, channel, channelstate):
+        """Sets the state to a snapshot of the client and one channel"""
+        self.nick = clientstate['nick']
+        self.user = clientstate['user']
+        self.clientprefix = clientstate['clientprefix']
+        self.channels = set(clientstate['channels'])
+        self.members.clear()
+        if channelstate is not None:
+            channel = irc_lower(channel)
+            self.members.channel2nicks[channel] = set()
+            for nick in channelstate['nicks']:
+                self.members.join(nick, channel)
+            if channelstate['namreply'] is not None:
+                self.members.names(channel, channelstate['namreply'])
+
+class FusedPipeline(IrcFilter):
+    """A pipeline that handles each line like the given one with
+    AddRegisteredFilter in front, but in one function that has the code of
+    the stages that have fused_code, without the calls between them. The
+    fused code of each class must do what its methods do, and isn't used
+    for subclasses, which may do something else."""
+    transparent = True
+    adds_registered = True # see registered()
+
+    def __init__(self, sink):
+        IrcFilter.__init__(self, sink)
+        code = ["def handleReceived(line):",
+                "    cmd = line.cmd",
+                AddRegisteredFilter.fused_code]
+        namespace = {}
+        stage = sink
+        while stage is not None and 'fused_code' in stage.__class__.__dict__:
+            name = "stage%d" % len(namespace)
+            namespace[name] = stage
+            code.append(stage.fused_code % {'stage': name})
+            stage = stage.sink
+        if stage is not None: # the rest can't be fused
+            namespace['rest'] = stage
+            code.append("    rest.handleReceived(line)")
+        exec "\n".join(code) in namespace
+        self.handleReceived = namespace['handleReceived']
+
+def compile_pipeline(pipeline):
+    """Returns a FusedPipeline for running the pipeline faster"""
+    return FusedPipeline(pipeline)
+
+def registered(pipeline):
+    """Returns the pipeline with AddRegisteredFilter in front, unless it
+    does the same itself"""
+    if getattr(pipeline, 'adds_registered', False):
+        return pipeline
+    return AddRegisteredFilter(pipeline)
+
+class ChannelDemuxFilter(ChannelFilter):
+    """A filter that passes on the lines related to each channel to a sink
+    of its own, created by calling create_sink with the (lower case)
+    channel name when the channel is first seen. Works like a ChannelFilter
+    for every channel, tracking the channel state only once."""
+    def __init__(self, create_sink):
+        ChannelFilter.__init__(self, None, None)
+        self.create_sink = create_sink
+        self.channelsinks = {} # channel -> sink
+
+    def handleReceived(self, line):
+        for channel in self.track(line):
+            if not channel or channel[0] not in "#&+!":
+                continue # a private message
+            if channel not in self.channelsinks:
+                self.channelsinks[channel] = self.create_sink(channel)
+            self.channelsinks[channel].handleReceived(line)
+
+    def handleReceivedBatch(self, lines):
+        batches = {} # channel -> its lines in the batch
+        for line in lines:
+            for channel in self.track(line):
+                if not channel or channel[0] not in "#&+!":
+                    continue # a private message
+                batches.setdefault(channel, []).append(line)
+        for channel, channellines in batches.iteritems():
+            if channel not in self.channelsinks:
+                self.channelsinks[channel] = self.create_sink(channel)
+            self.channelsinks[channel].handleReceivedBatch(channellines)
+
+    def close(self):
+        for sink in self.channelsinks.values():
+            sink.close()
+
 class TimeFilter(IrcFilter):
     """A filter that only passes on lines whose time matches a given prefix"""
+    transparent = True
+
     def __init__(self, timeprefix, sink):
         IrcFilter.__init__(self, sink)
         self.timeprefix = timeprefix
@@ -244,8 +437,51 @@ class TimeFilter(IrcFilter):
         if line.ztime.startswith(self.timeprefix):
             self.sink.handleReceived(line)
 
+    def handleReceivedBatch(self, lines):
+        timeprefix = self.timeprefix
+        self.sink.handleReceivedBatch([line for line in lines
+                                       if line.ztime.startswith(timeprefix)])
+
+    # the same in FusedPipeline:
+    fused_code = """
+    if not line.ztime.startswith(%(stage)s.timeprefix):
+        return"""
+
+    def prefilter(self):
+        days = local_days(self.timeprefix)
+        if days is None:
+            return None
+        first, last = days
+        return lambda l: first <= l[:len("YYYY-MM-DD")] <= last
+
+def local_days(timeprefix):
+    """Returns the first and the last local day of the times in UTC that
+    have the prefix, or None if the prefix isn't a whole year, month, day,
+    hour, minute or second"""
+    if len(timeprefix) not in (4, 7, 10, 13, 16, 19):
+        return None
+    try:
+        start = datetime.datetime.strptime(
+            timeprefix + "0000-01-01T00:00:00"[len(timeprefix):],
+            "%Y-%m-%dT%H:%M:%S")
+        if len(timeprefix) == 4:
+            end = start.replace(year=start.year+1)
+        elif len(timeprefix) == 7:
+            end = start.replace(year=start.year+start.month/12,
+                                month=start.month%12+1)
+        else:
+            unit = {10: 'days', 13: 'hours', 16: 'minutes', 19: 'seconds'}
+            end = start + datetime.timedelta(**{unit[len(timeprefix)]: 1})
+        # the timezones are less than a day away from UTC:
+        day = datetime.timedelta(days=1)
+        return (start - day).date().isoformat(), (end + day).date().isoformat()
+    except (ValueError, OverflowError):
+        return None
+
 class OffFilter(IrcFilter):
     """A filter that removes lines marked as off-the-record"""
+    transparent = True
+
     def irc_PRIVMSG(self, line):
         content = line.args[1]
 
@@ -256,6 +492,20 @@ class OffFilter(IrcFilter):
     def handleReceivedFallback(self, line):
         self.sink.handleReceived(line)
 
+    def handleReceivedBatch(self, lines):
+        off = self.irc_PRIVMSG
+        self.sink.handleReceivedBatch([line for line in lines
+                                       if line.cmd != "PRIVMSG" or
+                                       not off(line)])
+
+    # the same in FusedPipeline:
+    fused_code = """
+    if cmd == "PRIVMSG":
+        content = line.args[1]
+        if (content.startswith("[off]") or
+            content.startswith("\\1ACTION [off]")):
+            return"""
+
 
 class EventSink(IrcSink):
     def __init__(self, root, channel, timeprefix, selfuri):
@@ -355,11 +605,82 @@ class BackLogHtmlSink(HtmlSink):
         HtmlSink.close(self)
 
 
+class BackLogStartSink(IrcSink):
+    """A sink that finds a time from which BackLogHtmlSink gets the same
+    backlog as from all the lines of the channel, from the lines given
+    newest first (see run_tail()). The backlog starts from the last time
+    the nick was active on the channel and someone else said something
+    after it, so the time is that of the last message before it, or when
+    the nick was last seen joining the channel before it, if earlier, so
+    that ChannelFilter knows the nick is on the channel when it quits.
+
+    NICKs and QUITs may not be related to the channel, so they aren't
+    counted as activity, which can only make the time earlier. If someone
+    else changed their nick to the nick, since is None."""
+    def __init__(self, nick, channel, up_to=None):
+        IrcSink.__init__(self)
+        self.nick = nick
+        self.channel = irc_lower(channel)
+        self.up_to = up_to
+        self.answered = False # someone else said something after
+        self.active = False # the nick was active before that
+        self.message = False # the message before that is found
+        self.member = False # the nick joining before that is found
+        self.failed = False
+        self.since = None
+
+    def prefilter(self):
+        channel = self.channel
+        def accept(l):
+            # the lines of the channel, or nicks becoming the nick:
+            l = irc_lower(l)
+            return channel in l or " nick " in l or " 001 " in l
+        return accept
+
+    def handleReceived(self, line):
+        if self.up_to and line.ztime[:len(self.up_to)] >= self.up_to:
+            return
+        cmd, args = line.cmd, line.args
+        nick,_ = parseprefix(line.prefix or "")
+        if cmd == "001": # RPL_WELCOME resets the channel state
+            self.member = self.active
+        elif cmd == "353" and irc_lower(args[2]) == self.channel:
+            names = [irc_lower(n.lstrip("@").lstrip("+"))
+                     for n in args[3].split()]
+            self.member = self.active and irc_lower(self.nick) in names
+        elif cmd == "NICK" and irc_lower(args[0]) == irc_lower(self.nick):
+            self.failed = not self.active
+        elif (cmd in ("PRIVMSG", "NOTICE", "PART", "KICK", "TOPIC", "JOIN")
+              and nick and irc_lower(args[0]) == self.channel):
+            if self.active:
+                self.member = self.member or (cmd == "JOIN" and
+                                              nick == self.nick)
+            elif nick != self.nick:
+                self.answered = self.answered or cmd == "PRIVMSG"
+            elif self.answered and cmd != "JOIN":
+                self.active = True
+            self.message = self.message or (self.active and
+                                             cmd == "PRIVMSG")
+        else:
+            return
+        if self.message and self.member:
+            self.since = line.ztime
+
+    def satisfied(self):
+        return self.since is not None or self.failed
+
+
 class UserFilter(IrcFilter):
+    transparent = True
+
     def __init__(self, user, sink):
         IrcFilter.__init__(self, sink)
         self.user = user
 
+    def prefilter(self):
+        prefix = " :%s!" % self.user
+        return lambda l: prefix in l
+
     def handleReceived(self, line):
         if not line.prefix:
             return
@@ -367,32 +688,126 @@ class UserFilter(IrcFilter):
         if nick == self.user:
             self.sink.handleReceived(line)
 
+    def handleReceivedBatch(self, lines):
+        user = self.user
+        self.sink.handleReceivedBatch([line for line in lines if line.prefix
+                                       and parseprefix(line.prefix)[0] == user])
+
 
 class ChannelMessageTailFilter(IrcFilter):
-    def __init__(self, n, sink):
+    """A filter that passes on the last n messages of each channel when it
+    is closed. Given the channels, it is satisfied when it has n messages
+    of each of them from lines given newest first, see run_tail()."""
+    newest_first = False # set by run_tail()
+
+    def __init__(self, n, sink, channels=None):
         IrcFilter.__init__(self, sink)
         self.n = n
-        self.channels = {}
+        self.channels = {} # channel -> deque of (count, line)
         self.count = 0
+        self.wanted = channels and set(irc_lower(c) for c in channels)
 
     def irc_PRIVMSG(self, line):
         channel = line.args[0]
         if not channel.startswith("#"):
             return True # filter out
 
-        self.channels[channel] = [(self.count, line)] + self.channels.get(channel, [])[:self.n]
-        self.count += 1
+        lines = self.channels.get(channel)
+        if lines is None:
+            lines = self.channels[channel] = deque(maxlen=self.n)
+        if self.newest_first:
+            self.count -= 1
+            if len(lines) < self.n:
+                lines.appendleft((self.count, line))
+        else:
+            lines.append((self.count, line)) # drops the oldest one
+            self.count += 1
         return True # we'll rehandle this later
 
+    def satisfied(self):
+        if not self.wanted:
+            return False
+        full = set(irc_lower(c) for c, lines in self.channels.iteritems()
+                   if len(lines) >= self.n)
+        return self.wanted <= full
+
+    def merge(self, other):
+        merge_tails(self.channels, other.channels, self.count, self.n)
+        self.count += other.count
+
     def close(self):
-        events = sum(self.channels.values(), [])
+        events = [event for lines in self.channels.itervalues()
+                  for event in lines]
         events.sort()
         for _,line in events:
             self.sink.handleReceived(line)
 
+def merge_tails(tails, othertails, offset, n):
+    """Adds the deques of (count, line) of the later lines to the ones of
+    the earlier lines by key, counting the later lines from offset"""
+    for key, lines in othertails.iteritems():
+        tail = tails.get(key)
+        if tail is None:
+            tail = tails[key] = deque(maxlen=n)
+        tail.extend((offset + count, line) for count, line in lines)
+
+class LatestMessagesSink(IrcSink):
+    """A sink that keeps the latest n messages of each channel, and of each
+    nick on each channel. Kept up to date with run_resumable(), the pages
+    can get them without reading the logs."""
+    def __init__(self, n=5):
+        IrcSink.__init__(self)
+        self.n = n
+        self.count = 0
+        self.channel2lines = {} # channel -> deque of (count, line)
+        self.nick2lines = {} # nick -> channel -> deque of (count, line)
+
+    def irc_PRIVMSG(self, line):
+        channel = line.args[0]
+        if not channel.startswith("#") or not line.prefix:
+            return True
+        channel = irc_lower(channel)
+        nick,_ = parseprefix(line.prefix)
+
+        event = (self.count, line)
+        self.count += 1
+        for tails in [self.channel2lines,
+                      self.nick2lines.setdefault(nick, {})]:
+            lines = tails.get(channel)
+            if lines is None:
+                lines = tails[channel] = deque(maxlen=self.n)
+            lines.append(event)
+        return True
+
+    handleReceivedFallback = lambda self,x:None
+
+    def merge(self, other):
+        merge_tails(self.channel2lines, other.channel2lines, self.count,
+                    self.n)
+        for nick, tails in other.nick2lines.iteritems():
+            merge_tails(self.nick2lines.setdefault(nick, {}), tails,
+                        self.count, self.n)
+        self.count += other.count
+
+    def channel_messages(self, channel, n=None):
+        """Returns the latest n messages of the channel, oldest first"""
+        lines = self.channel2lines.get(irc_lower(channel), ())
+        return [line for _,line in list(lines)[-(n or self.n):]]
+
+    def nick_messages(self, nick, n=1):
+        """Returns the latest n messages of the nick on each channel, oldest
+        first, like ChannelMessageTailFilter after UserFilter"""
+        events = [event
+                  for lines in self.nick2lines.get(nick, {}).itervalues()
+                  for event in list(lines)[-n:]]
+        events.sort()
+        return [line for _,line in events]
+
 
 class TurtleSink(IrcSink):
-    """A sink that renders the lines it receives as a Turtle RDF document"""
+    """A sink that renders the lines it receives as a Turtle RDF document.
+    The triples of each line are written as it arrives, and only the ones
+    about the nicks seen are written when it is closed."""
     def __init__(self, root, channel, timeprefix):
         IrcSink.__init__(self)
         self.root = root
@@ -401,21 +816,34 @@ class TurtleSink(IrcSink):
         self.channelID = self.channel.strip("#").lower()
         self.channelURI = self.root + self.channelID + "#channel"
 
-        oldChannelURI = "irc://freenode/%23" + self.channelID
-
-        self.triples = []
+        self.writer = None # started when the first triples are written
         self.base = self.root
         self.seenNicks = {}
 
-        self.triples += [(self.channelURI, OWL.sameAs, oldChannelURI),
-                         (self.channelURI, RDF.type, SIOC.Forum),
-                         (self.channelURI, RDF.type, SIOCT.ChatChannel),
-                         (self.channelURI, RDFS.label, 
-                          PlainLiteral("#" + self.channel)),
-                         ]
+    def start(self):
+        """Writes the start of the document, with the triples about the
+        channel, and returns the writer"""
+        if self.writer is None:
+            oldChannelURI = "irc://freenode/%23" + self.channelID
+
+            self.writer = TurtleWriter(None, namespaces, grouped=True)
+            title = "Log of #%s on %s" % (self.channel, self.timeprefix)
+            self.writer.write([("", RDFS.label, PlainLiteral(title)),
+                               ("", FOAF.primaryTopic, self.channelURI),
+                               ])
+            self.writer.setBase(self.base)
+            self.writer.write([(self.channelURI, OWL.sameAs, oldChannelURI),
+                               (self.channelURI, RDF.type, SIOC.Forum),
+                               (self.channelURI, RDF.type, SIOCT.ChatChannel),
+                               (self.channelURI, RDFS.label,
+                                PlainLiteral("#" + self.channel)),
+                               ])
+        return self.writer
 
     def irc_PRIVMSG(self, line):
-        self.triples += self.create_triples(line)
+        triples = self.create_triples(line)
+        if triples:
+            self.start().write(triples)
         
     def create_triples(self, line):
         id = line.ztime.split("T")[1][:-1] # FIXME not unique
@@ -457,23 +885,16 @@ class TurtleSink(IrcSink):
                  for uri in line.links]
 
     def close(self):
+        writer = self.start()
         for nick in self.seenNicks:
             creator = self.root + "users/" + nick + "#user"
             oldCreator = "irc://freenode/" + nick + ",isuser"
                 
-            self.triples += [None,
-                             (creator, OWL.sameAs, oldCreator),
-                             (creator, RDFS.label, PlainLiteral(nick)),
-                             (creator, RDF.type, SIOC.User),
-                             ]
-
-        writer = TurtleWriter(None, namespaces)
-        title = "Log of #%s on %s" % (self.channel, self.timeprefix)
-        writer.write([("", RDFS.label, PlainLiteral(title)),
-                      ("", FOAF.primaryTopic, self.channelURI),
-                      ])
-        writer.setBase(self.base)
-        writer.write(self.triples)
+            writer.write([None,
+                          (creator, OWL.sameAs, oldCreator),
+                          (creator, RDFS.label, PlainLiteral(nick)),
+                          (creator, RDF.type, SIOC.User),
+                          ])
         writer.close()
 
 
@@ -486,6 +907,10 @@ class RawSink(IrcSink):
 def incvalue(store, key):
     store[key] = store.get(key, 0) + 1
 
+def addvalues(store, other):
+    for key, value in other.iteritems():
+        store[key] = store.get(key, 0) + value
+
 class ChannelsAndDaysSink(IrcSink):
     """A sink that collects the channels and days of activity that it sees"""
     def __init__(self):
@@ -544,6 +969,22 @@ class ChannelsAndDaysSink(IrcSink):
 
     handleReceivedFallback = lambda self,x:None
 
+    def merge(self, other):
+        for store, otherstore in [(self.days, other.days),
+                                  (self.channels, other.channels),
+                                  (self.nicks, other.nicks)]:
+            addvalues(store, otherstore)
+        for store, otherstore in [(self.day2channels, other.day2channels),
+                                  (self.channel2days, other.channel2days),
+                                  (self.nick2channels, other.nick2channels),
+                                  (self.channel2nicks, other.channel2nicks)]:
+            for key, counts in otherstore.iteritems():
+                addvalues(store.setdefault(key, {}), counts)
+        # the other saw the later lines:
+        self.channel2topic.update(other.channel2topic)
+        self.channel2latest.update(other.channel2latest)
+        self.nick2latest.update(other.nick2latest)
+
 
 class TaxonomySink(IrcSink):
     """A sink that collects the NickServ taxonomy information it sees"""
@@ -554,6 +995,10 @@ class TaxonomySink(IrcSink):
         self.taxonomy_response = None
         self.taxonomy = {}
 
+        # the messages before the first response, see merge():
+        self.started = False
+        self.head = []
+
     def irc_NOTICE(self, line):
         if line.args[0].startswith("#"):
             return False
@@ -561,6 +1006,14 @@ class TaxonomySink(IrcSink):
             return False
 
         msg = line.args[1]
+        if not self.started:
+            if not msg.startswith("Taxonomy for \2"):
+                self.head.append(msg)
+                return
+            self.started = True
+        self.handle_taxonomy(msg)
+
+    def handle_taxonomy(self, msg):
         if msg.startswith("Taxonomy for \2"):
             nick = msg[len("Taxonomy for \2"):-2]
             self.taxonomy_state = nick
@@ -574,32 +1027,537 @@ class TaxonomySink(IrcSink):
             value = rest.split(":", 1)[1][1:]
             self.taxonomy_response.append((self.taxonomy_state, key, value))
 
+    def replay(self, msgs):
+        """Handles the messages kept in a head, each on its own like
+        handle_lines() does, so that a broken one is only reported"""
+        for msg in msgs:
+            try:
+                self.handle_taxonomy(msg)
+            except:
+                print_exc()
+                print >>sys.stderr, "... on a NickServ notice: %s" % msg
+
+    def merge(self, other):
+        # a response starts the state afresh, so only the messages before
+        # the first one depend on the lines before them:
+        if self.started:
+            self.replay(other.head)
+        else:
+            self.head += other.head
+        if other.started:
+            self.started = True
+            self.taxonomy.update(other.taxonomy)
+            self.taxonomy_state = other.taxonomy_state
+            self.taxonomy_response = other.taxonomy_response
 
-def run(sources, pipeline):
-    """Processes each line from the sources in the pipeline and closes it"""
+    def close(self):
+        # the head is from the start, before any response:
+        state, response = self.taxonomy_state, self.taxonomy_response
+        self.taxonomy_state = self.taxonomy_response = None
+        self.replay(self.head)
+        self.head = []
+        self.taxonomy_state, self.taxonomy_response = state, response
+        IrcSink.close(self)
+
+
+def parse_logline(l):
+    """Parses a line of a log file into a Line, or rather a LazyLine that
+    parses the IRC line only when needed"""
+    time, linestr = l[:-1].split(" ",1)
+    linestr = linestr.rstrip('\r') # according to RFC, there is \r
+    return LazyLine(linestr, time)
+
+def read_range(source, start, end):
+    """Yields the lines of a file from the start offset to the end offset,
+    or to the end of the file if end is None"""
+    source.seek(start) # also drops what the iteration has read ahead
+    pos = start
+    for l in source: # much faster than readline()
+        if end is not None and pos >= end:
+            break
+        pos += len(l)
+        yield l
+
+REVERSE_BLOCK_SIZE = 65536
+
+def reverse_range(source, start, end):
+    """Yields the lines of a file from the end offset, or the end of the
+    file if end is None, back to the start offset, newest first"""
+    if end is None:
+        end = log_size(source)
+    pos = end
+    carry = "" # the end of a line that starts before pos
+    while pos > start:
+        size = min(REVERSE_BLOCK_SIZE, pos - start)
+        pos -= size
+        source.seek(pos)
+        data = source.read(size) + carry
+        if pos > start:
+            cut = data.find("\n") + 1
+            if not cut:
+                carry = data # a long line
+                continue
+            carry, data = data[:cut], data[cut:]
+        lines = data.split("\n")
+        last = lines.pop()
+        if last: # the last line is still being written
+            yield last
+        for l in reversed(lines):
+            yield l + "\n"
+
+def time_key(timestamp):
+    """Returns a key for comparing W3C timestamps and UTC time prefixes"""
+    return (convert_timestamp_to_z(timestamp) or timestamp).rstrip("Z")
+
+def line_at(source, offset):
+    """Returns the offset of the first line starting at or after an offset,
+    and the line"""
+    if offset:
+        source.seek(offset - 1)
+        source.readline()
+    else:
+        source.seek(0)
+    start = source.tell()
+    return start, source.readline()
+
+def find_time(source, key, size):
+    """Returns the offset of the first line in a time-ordered log file
+    whose time isn't before a time key, using binary search"""
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start, l = line_at(source, mid)
+        if l and time_key(l.split(" ",1)[0]) < key:
+            lo = start + len(l)
+        else:
+            hi = mid
+    return lo
+
+def find_time_range(source, since=None, until=None):
+    """Returns the start and end offsets of the lines in a time-ordered log
+    file from the time since up to, but not including, the time until.
+    The end is None if there is no limit."""
+    size = log_size(source)
+    start = end = None
+    if since:
+        start = find_time(source, time_key(since), size)
+    if until:
+        end = find_time(source, time_key(until), size)
+    return start or 0, end
+
+def read_time_range(source, since=None, until=None):
+    """Yields the lines in a time-ordered log file from the time since up
+    to, but not including, the time until"""
+    start, end = find_time_range(source, since, until)
+    return read_range(source, start, end)
+
+def clip_ranges(ranges, start, end):
+    clipped = []
+    for s, e in ranges:
+        s = max(s, start)
+        if e is None or (end is not None and end < e):
+            e = end
+        if e is None or s < e:
+            clipped.append((s, e))
+    return clipped
+
+def intersect_ranges(ranges, others):
+    """Returns the parts of the sorted ranges that are in the other sorted
+    ranges"""
+    intersection = []
+    for start, end in others:
+        for s, e in clip_ranges(ranges, start, end):
+            if intersection and intersection[-1][1] == s:
+                intersection[-1] = intersection[-1][0], e
+            else:
+                intersection.append((s, e))
+    return intersection
+
+# lines in a batch, see handle_batches()
+BATCH_SIZE = 1000
+
+def handle_lines(pipeline, name, lines, batchsize=None, parsed=False):
+    """Passes the lines of a log file to the pipeline, or Lines if parsed
+    is true"""
+    if batchsize:
+        return handle_batches(pipeline, name, lines, batchsize, parsed)
+    accept = None if parsed else pipeline_prefilter(pipeline)
+    for i, l in enumerate(lines):
+        #print l
+        if accept is not None and not accept(l):
+            continue # without parsing
+        try:
+            pipeline.handleReceived(l if parsed else parse_logline(l))
+        except:
+            print_exc()
+            print >>sys.stderr, "... on %s:%s: %s" % (name, i+1, l)
+
+def handle_batches(pipeline, name, lines, batchsize, parsed=False):
+    """Passes the lines to the pipeline in lists of batchsize lines. The
+    lines that can't be parsed are left out, but an error in the pipeline
+    loses the rest of the batch in the stage where it happens."""
+    accept = None if parsed else pipeline_prefilter(pipeline)
+    batch = []
+    for i, l in enumerate(lines):
+        if accept is not None and not accept(l):
+            continue # without parsing
+        try:
+            line = l if parsed else parse_logline(l)
+            line.cmd # parse now
+        except:
+            print_exc()
+            print >>sys.stderr, "... on %s:%s: %s" % (name, i+1, l)
+            continue
+        batch.append(line)
+        if len(batch) == batchsize:
+            handle_batch(pipeline, name, i+1, batch)
+            batch = []
+    if batch:
+        handle_batch(pipeline, name, i+1, batch)
+
+def handle_batch(pipeline, name, end, batch):
+    try:
+        pipeline.handleReceivedBatch(batch)
+    except:
+        print_exc()
+        print >>sys.stderr, "... on %s:%s in a batch of %d lines" % (
+            name, end, len(batch))
+
+def pipeline_stages(pipeline):
+    """Yields the stages of a pipeline, including the ones after a
+    TeeFilter"""
+    while pipeline is not None:
+        yield pipeline
+        for sink in getattr(pipeline, 'sinks', []):
+            for stage in pipeline_stages(sink):
+                yield stage
+        pipeline = getattr(pipeline, 'sink', None)
+
+def pipeline_prefilter(pipeline):
+    """Returns a function that tells from a line of a log file whether it
+    can matter to the pipeline, or None if any line can. The stages after
+    one that isn't transparent aren't asked, as the lines they would drop
+    can still affect it."""
+    predicates = []
+    for stage in pipeline_stages(pipeline):
+        predicate = stage.prefilter()
+        if predicate is not None:
+            predicates.append(predicate)
+        if not stage.transparent:
+            break
+    if not predicates:
+        return None
+    elif len(predicates) == 1:
+        return predicates[0]
+    return lambda l: all(p(l) for p in predicates)
+
+def seed_pipeline(pipeline, channel, clientstate, channelstate):
+    for stage in pipeline_stages(pipeline):
+        if (isinstance(stage, ChannelFilter) and
+            stage.interestingchannel == irc_lower(channel)):
+            stage.seed(clientstate, channel, channelstate)
+
+def run(sources, pipeline, channel=None, timeprefix=None,
+        since=None, until=None, keepstate=False, batchsize=None, nick=None):
+    """Processes each line from the sources in the pipeline and closes it.
+    The sources are open files or names of log files, which can also be
+    compressed or block segments (see logsegments.py), or databases (see
+    logdb.py).
+
+    The rest of the arguments are hints for reading only the parts of the
+    sources where lines of the channel, matching the time prefix,
+    between the times since and until and from the nick can be. Sources
+    that have an index (see logindex.py) are looked up in it, the
+    segments that can't have lines of the channel or the nick are skipped
+    by their summaries, and the times are found with binary search in the
+    log files. Databases are
+    queried. The pipeline must still filter the lines it gets. The
+    ChannelFilters of the channel in the pipeline are seeded with the
+    channel state from the index, if there is one.
+    Otherwise, they can't relate all NICKs and QUITs to the channel if
+    lines before the given times aren't read, unless keepstate is true.
+
+    With a batchsize, the lines are passed to the pipeline in lists, see
+    handle_batches()."""
     if not isinstance(sources, list):
         sources = [sources]
 
-    pipeline = AddRegisteredFilter(pipeline)
+    if timeprefix: # "~" sorts after the times with the prefix
+        since = max(time_key(since or ""), timeprefix)
+        until = min(time_key(until or "~"), timeprefix + "~")
+
+    pipeline = registered(pipeline)
 
     for source in sources:
-        if not isinstance(source, file):
+        if hasattr(source, 'find_lines'): # a database
+            snapshot, lines = source.find_lines(channel, timeprefix, since,
+                                                until, nick, keepstate)
+            if snapshot is not None:
+                seed_pipeline(pipeline, channel, *snapshot)
+            handle_lines(pipeline, source.name, lines, batchsize, True)
+            continue
+        if isinstance(source, basestring):
             try:
-                source = file(source)
+                source = open_log(source)
             except:
                 print_exc()
                 continue
-        for i, l in enumerate(source):
-            #print l
-            time, linestr = l[:-1].split(" ",1)
+        ranges = snapshot = None
+        if seekable(source):
+            if channel or timeprefix:
+                found = logindex.find_ranges(source, channel, timeprefix)
+                if found is not None:
+                    ranges, snapshot = found
+            if since or until:
+                start, end = find_time_range(source, since, until)
+                if snapshot is not None:
+                    start = snapshot[0] # read the channel from the snapshot
+                elif keepstate:
+                    start = 0 # replay the channel state from the start
+                if ranges is None:
+                    ranges = [(0, None)]
+                ranges = clip_ranges(ranges, start, end)
+            if channel or nick or until: # skip the segments without them
+                segments = logindex.find_segments(source, channel, nick,
+                                                  None, until and
+                                                  time_key(until))
+                if segments is not None:
+                    if ranges is None:
+                        ranges = [(0, None)]
+                    ranges = intersect_ranges(ranges, segments)
+        if ranges is None:
+            handle_lines(pipeline, source.name, source, batchsize)
+        else:
+            if snapshot is not None and ranges:
+                _, clientstate, channelstate = snapshot
+                seed_pipeline(pipeline, channel, clientstate, channelstate)
+            for start, end in ranges:
+                handle_lines(pipeline, "%s@%d" % (source.name, start),
+                             read_range(source, start, end), batchsize)
+
+    pipeline.close()
+
+def run_tail(sources, pipeline, channel=None, since=None, until=None,
+             nick=None):
+    """Processes the lines from the sources in the pipeline newest first,
+    until a stage of the pipeline is satisfied, and closes it. The stages
+    must not depend on the order of the lines, like ChannelFilter does,
+    and the ones that keep some of the lines should have newest_first,
+    which is set. A stage that is satisfied when the lines before the ones
+    it has seen can't change its results has a satisfied() method.
+
+    The rest of the arguments are hints like in run(). The sources that
+    aren't log files or databases are read to the end first."""
+    if not isinstance(sources, list):
+        sources = [sources]
+
+    pipeline = registered(pipeline)
+    stages = list(pipeline_stages(pipeline))
+    for stage in stages:
+        stage.newest_first = True
+    checks = [stage.satisfied for stage in stages
+              if hasattr(stage, 'satisfied')]
+    satisfied = lambda: any(check() for check in checks)
+
+    for source in reversed(sources):
+        if hasattr(source, 'find_lines'): # a database
+            _, lines = source.find_lines(channel, None, since, until, nick,
+                                         newest_first=True)
+            if handle_tail(pipeline, source.name, lines, satisfied, True):
+                break
+            continue
+        if isinstance(source, basestring):
             try:
-                linestr = linestr.rstrip('\r') # according to RFC, there is \r
-                pipeline.handleReceived(Line(linestr=linestr, time=time))
+                source = open_log(source)
             except:
                 print_exc()
-                print >>sys.stderr, "... on %s:%s: %s" % (source.name, i+1, l)
+                continue
+        if not seekable(source):
+            lines = reversed(list(source))
+        else:
+            ranges = [(0, None)]
+            if since or until:
+                ranges = clip_ranges(ranges,
+                                     *find_time_range(source, since, until))
+            if channel or nick or until: # skip the segments without them
+                segments = logindex.find_segments(source, channel, nick,
+                                                  None, until and
+                                                  time_key(until))
+                if segments is not None:
+                    ranges = intersect_ranges(ranges, segments)
+            lines = (l for start, end in reversed(ranges)
+                     for l in reverse_range(source, start, end))
+        if handle_tail(pipeline, source.name, lines, satisfied):
+            break
+
+    pipeline.close()
+
+def handle_tail(pipeline, name, lines, satisfied, parsed=False):
+    """Passes the lines to the pipeline like handle_lines(), and returns
+    True as soon as it is satisfied"""
+    accept = None if parsed else pipeline_prefilter(pipeline)
+    for i, l in enumerate(lines):
+        if accept is not None and not accept(l):
+            continue # without parsing
+        try:
+            pipeline.handleReceived(l if parsed else parse_logline(l))
+        except:
+            print_exc()
+            print >>sys.stderr, "... on %s:-%s: %s" % (name, i+1, l)
+        if satisfied():
+            return True
+    return False
+
+def split_file(source, chunksize, start=0, end=None):
+    """Returns the ranges of a file from start to end split into chunks at
+    line boundaries. A compressed file is one chunk."""
+    if not seekable(source):
+        return [(start, end)]
+    if end is None:
+        end = log_size(source)
+    offsets = [start]
+    while offsets[-1] + chunksize < end:
+        offset, l = line_at(source, offsets[-1] + chunksize)
+        if not l or offset >= end:
+            break
+        offsets.append(offset)
+    return zip(offsets, offsets[1:] + [end])
+
+def complete_size(source):
+    """Returns the size of a file up to the end of its last complete line"""
+    end = log_size(source)
+    while end > 0:
+        start = max(0, end - 65536)
+        source.seek(start)
+        i = source.read(end - start).rfind("\n")
+        if i != -1:
+            return start + i + 1
+        end = start
+    return 0
+
+def run_chunk(chunk):
+    create_pipeline, name, start, end = chunk
+    pipeline = create_pipeline()
+    with open_log(name) as source:
+        handle_lines(registered(pipeline), "%s@%d" % (name, start),
+                     read_range(source, start, end), BATCH_SIZE)
+    return pipeline
+
+def run_chunks(chunks, create_pipeline, pipeline=None, processes=None):
+    """Processes the chunks (name, start, end) of log files in parallel
+    processes, merging the results into the pipeline, and returns it. The
+    lines are passed in batches, see handle_batches()."""
+    if len(chunks) <= 1 or processes == 1:
+        if pipeline is None:
+            pipeline = create_pipeline()
+        wrapped = registered(pipeline)
+        for name, start, end in chunks:
+            with open_log(name) as source:
+                handle_lines(wrapped, "%s@%d" % (name, start),
+                             read_range(source, start, end), BATCH_SIZE)
+        return pipeline
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(run_chunk, [(create_pipeline,) + chunk
+                                            for chunk in chunks]):
+            if pipeline is None:
+                pipeline = result
+            else:
+                pipeline.merge(result)
+    finally:
+        pool.close()
+        pool.join()
+    return pipeline
+
+PARALLEL_CHUNK_SIZE = 4*1024*1024
+
+def run_parallel(logfiles, create_pipeline, processes=None):
+    """Processes the lines of the log files like run() in chunks in
+    parallel processes and returns the pipeline with the results merged.
+
+    The pipeline is created by calling create_pipeline for each chunk, so
+    it needs to be picklable, e.g. a sink class. The stages of the pipeline
+    must support merge(), i.e. they can't depend on the earlier lines; the
+    ones that do raise TypeError."""
+    if not isinstance(logfiles, list):
+        logfiles = [logfiles]
+
+    chunks = []
+    for name in logfiles:
+        try:
+            with open_log(name) as source:
+                chunks += [(name, start, end)
+                           for start, end in split_file(source,
+                                                        PARALLEL_CHUNK_SIZE)]
+        except:
+            print_exc()
+
+    pipeline = run_chunks(chunks, create_pipeline, None, processes)
+    pipeline.close()
+    return pipeline
+
+def find_new_chunks(logfiles, offsets):
+    """Returns the chunks of the log files after the offsets of the files
+    and the new offsets, or None if a file has been truncated"""
+    chunks = []
+    offsets = dict(offsets)
+    for name in logfiles:
+        try:
+            with open_log(name) as source:
+                if not seekable(source): # compressed, read once as a whole
+                    st = os.stat(name)
+                    if (st.st_dev, st.st_ino) not in offsets:
+                        chunks.append((name, 0, None))
+                    offsets[(st.st_dev, st.st_ino)] = 0
+                    continue
+                st = os.fstat(source.fileno())
+                key = (st.st_dev, st.st_ino)
+                start = offsets.get(key, 0)
+                end = complete_size(source)
+                if end < start:
+                    return None
+                offsets[key] = end
+                chunks += [(name, s, e)
+                           for s, e in split_file(source, PARALLEL_CHUNK_SIZE,
+                                                  start, end)
+                           if s < e]
+        except:
+            print_exc()
+    return chunks, offsets
+
+def run_resumable(logfiles, create_pipeline, checkpoint, processes=None):
+    """Processes the lines of the log files like run_parallel(), but starts
+    from the pipeline saved in the checkpoint file and only processes the
+    lines appended to the logs since. Then saves the new checkpoint.
+
+    The log files are recognized by their inodes, so that they can be
+    renamed when rotated. Only complete lines are processed."""
+    if not isinstance(logfiles, list):
+        logfiles = [logfiles]
+
+    try:
+        with file(checkpoint, "rb") as f:
+            offsets, pipeline = cPickle.load(f)
+    except:
+        offsets, pipeline = {}, None # no checkpoint yet or it's outdated
+
+    found = find_new_chunks(logfiles, offsets)
+    if found is None:
+        pipeline = None # a log was truncated, start over
+        found = find_new_chunks(logfiles, {})
+    chunks, offsets = found
+
+    pipeline = run_chunks(chunks, create_pipeline, pipeline, processes)
+
+    if chunks:
+        tmpname = "%s.%d.tmp" % (checkpoint, os.getpid())
+        with file(tmpname, "wb") as f:
+            cPickle.dump((offsets, pipeline), f, 2)
+        os.rename(tmpname, checkpoint)
 
     pipeline.close()
+    return pipeline
 
 if __name__ == '__main__':
     # test main
@@ -10,7 +10,7 @@ class IrcFilter(Irc):
     ...
 """
 
-import re, time, datetime
+import re, time, datetime, string
 from traceback import print_exc
 
 from twisted.protocols import basic
@@ -33,7 +33,7 @@ def w3c_timestamp():
 datetimere = r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(\.\d+)?"
 timezonere = r"(Z|(\+|-)(\d{2}):(\d{2}))"
 timere = re.compile(datetimere + timezonere)
-def convert_timestamp_to_z(text):
+def parse_timestamp_to_z(text):
     # 2009-07-04T15:14:21.231+03:00
     match = timere.match(text)
     if match and match.group(0) == text:
@@ -52,6 +52,26 @@ def convert_timestamp_to_z(text):
             return utctime.isoformat() + fraction + "Z"
     return
 
+# consecutive lines of a log have almost always the same date, hour and
+# timezone, so their conversion is cached for the whole hour:
+hour_cache = {} # (local date and hour, timezone) -> UTC date and hour
+HOUR_CACHE_SIZE = 1024
+secondsre = re.compile(r":[0-5]\d:[0-5]\d(\.\d+)?\Z")
+def convert_timestamp_to_z(text):
+    """Converts a W3C timestamp with a timezone into UTC, or returns None
+    if it isn't one"""
+    hour, timezone = text[:13], text[-6:]
+    utchour = hour_cache.get((hour, timezone))
+    if utchour and secondsre.match(text, 13, len(text) - 6):
+        return utchour + text[13:-6] + "Z"
+
+    ztime = parse_timestamp_to_z(text)
+    if ztime and timezone[0] in "+-" and timezone.endswith(":00"):
+        if len(hour_cache) >= HOUR_CACHE_SIZE:
+            hour_cache.clear()
+        hour_cache[(hour, timezone)] = ztime[:13]
+    return ztime
+
 ### copy from irchub.py starts...
 
 def parseprefix(prefix):
@@ -99,6 +119,54 @@ class Line:
 
     __repr__ = __str__ # for nicer debug outputs
 
+class LazyLine(object):
+    """A Line read from a log, parsed only when its prefix, cmd, args or
+    ztime are first needed. Compact, as a full scan of the logs creates
+    one for every line, and most of them are filtered out unparsed."""
+    __slots__ = ('linestr', 'time', 'source', 'prefix', 'cmd', 'args',
+                 'ztime', 'registered', 'content_html', 'links')
+
+    def __init__(self, linestr, time=None, source=None):
+        self.linestr = linestr
+        self.time = time
+        self.source = source
+
+    def __getattr__(self, name):
+        # only called for the slots that haven't been set yet
+        if name in ('prefix', 'cmd', 'args'):
+            prefix, cmd, self.args = irc.parsemsg(self.linestr)
+            self.prefix = prefix or None
+            self.cmd = cmd.upper()
+        elif name == 'ztime':
+            self.ztime = None
+            if self.time:
+                self.ztime = convert_timestamp_to_z(self.time)
+        else:
+            raise AttributeError(name)
+        return getattr(self, name)
+
+    def __getstate__(self):
+        state = {}
+        for name in self.__slots__:
+            try: # without parsing the unset ones
+                state[name] = getattr(LazyLine, name).__get__(self)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+    def __str__(self):
+        return self.linestr
+
+    __repr__ = __str__ # for nicer debug outputs
+
+# the irc_CMD methods of each class by command, filled in as the commands
+# are seen, see Irc.handleReceived (clear after rebuilding the classes):
+dispatch_tables = {}
+
 class Irc(basic.LineReceiver):
     delimiter = '\n' # LineReceiver splits by this, everybody doesn't send \r
     factory = None # set in instances by the factory
@@ -117,9 +185,16 @@ class Irc(basic.LineReceiver):
         Calls method irc_CMD, where CMD is the name of the command or
         reply in the line. If there is no such method, or if the method
         doesn't return True, handleReceivedFallback is called."""
-        name = irc.numeric_to_symbolic.get(line.cmd, line.cmd)
-        method = getattr(self, "irc_%s" % name, None)
-        if method == None or not method(line):
+        table = dispatch_tables.get(self.__class__)
+        if table is None:
+            table = dispatch_tables[self.__class__] = {}
+        try:
+            method = table[line.cmd]
+        except KeyError:
+            name = irc.numeric_to_symbolic.get(line.cmd, line.cmd)
+            method = getattr(self.__class__, "irc_%s" % name, None)
+            method = table[line.cmd] = getattr(method, 'im_func', method)
+        if method == None or not method(self, line):
             self.handleReceivedFallback(line) # if not handled otherwise
 
     def noHandler(self, line):
@@ -134,3 +209,100 @@ class Irc(basic.LineReceiver):
         self.transport.loseConnection()
 
 ### ... copy from irchub.py ends
+
+# RFC 1459 considers {}|^ the lower case forms of []\~
+rfc1459_lower = string.maketrans(string.ascii_uppercase + "[]\\~",
+                                 string.ascii_lowercase + "{}|^")
+def irc_lower(name):
+    """Returns the lower case form of a nick or a channel name, to compare
+    them as the servers do."""
+    return name.translate(rfc1459_lower)
+
+class Membership(object):
+    """The members of the channels, as seen by a client.
+    Nicks and channels are looked up by their lower case forms
+    (irc_lower), and each update takes constant time for every nick and
+    channel it involves."""
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.nick2channels = {} # nick -> set of channels
+        self.channel2nicks = {} # channel -> set of nicks
+        self.nicks = {} # nick -> the nick as it was last seen
+        self.namreply = {} # ongoing NAMES replies, channel -> nick list
+
+    def channels(self):
+        """Returns the channels whose members are known or being listed"""
+        return set(self.channel2nicks) | set(self.namreply)
+
+    def channels_of(self, nick):
+        return self.nick2channels.get(irc_lower(nick), set())
+
+    def members(self, channel):
+        return [self.nicks[n]
+                for n in self.channel2nicks.get(irc_lower(channel), ())]
+
+    def join(self, nick, channel):
+        key, channel = irc_lower(nick), irc_lower(channel)
+        self.nicks[key] = nick
+        self.nick2channels.setdefault(key, set()).add(channel)
+        self.channel2nicks.setdefault(channel, set()).add(key)
+
+    # the state may be incomplete, so tolerate unknown nicks and channels:
+    def part(self, nick, channel):
+        key, channel = irc_lower(nick), irc_lower(channel)
+        self.channel2nicks.get(channel, set()).discard(key)
+        self.drop(key, channel)
+
+    def quit(self, nick):
+        key = irc_lower(nick)
+        channels = self.nick2channels.pop(key, set())
+        self.nicks.pop(key, None)
+        for c in channels:
+            self.channel2nicks.get(c, set()).discard(key)
+        return channels
+
+    def drop(self, key, channel):
+        channels = self.nick2channels.get(key, set())
+        channels.discard(channel)
+        if not channels:
+            self.nick2channels.pop(key, None)
+            self.nicks.pop(key, None)
+
+    def rename(self, oldnick, newnick):
+        oldkey, newkey = irc_lower(oldnick), irc_lower(newnick)
+        channels = self.nick2channels.pop(oldkey, set())
+        self.nicks.pop(oldkey, None)
+        if not channels:
+            return
+        self.nicks[newkey] = newnick
+        if newkey == oldkey: # only the case changed
+            self.nick2channels[newkey] = channels
+            return
+        self.nick2channels.setdefault(newkey, set()).update(channels)
+        for c in channels:
+            nicks = self.channel2nicks.setdefault(c, set())
+            nicks.discard(oldkey)
+            nicks.add(newkey)
+
+    def leave(self, channel):
+        """Forgets a channel, e.g. when we part it"""
+        channel = irc_lower(channel)
+        for key in self.channel2nicks.pop(channel, ()):
+            self.drop(key, channel)
+        self.namreply.pop(channel, None)
+
+    def names(self, channel, nicks):
+        """Adds nicks from a NAMES reply (RPL_NAMREPLY)"""
+        self.namreply.setdefault(irc_lower(channel), []).extend(
+            n.lstrip("@").lstrip("+") for n in nicks if n)
+
+    def end_names(self, channel):
+        """Replaces the members with the NAMES reply (RPL_ENDOFNAMES)"""
+        channel = irc_lower(channel)
+        newnicks = self.namreply.pop(channel, [])
+        self.leave(channel)
+        self.channel2nicks[channel] = set()
+        for nick in newnicks:
+            self.join(nick, channel)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""logdb.py - a module for storing the logs in an SQLite database
+
+The lines of the log files are loaded into a database, with the channels
+each line concerns as replayed by a ChannelFilter, so that NICKs and
+QUITs are related to the channels of the nick, and the state of the
+channels at the start of each day, like in the index (see logindex.py).
+Loading it again only adds the lines appended to the logs since.
+
+The database can be used as a source in run() in channellog.py, which
+then gets the lines of a channel, a day or a nick from the indexes of
+the database instead of reading the logs.
+
+Usage (the log files in order, oldest first):
+logdb.py sioclog.db freenode.log.2008 freenode.log
+
+Example usage:
+from logdb import Database
+run(Database("sioclog.db"), pipeline, "#sioc", "2009-09-01")
+"""
+
+from __future__ import with_statement
+
+import sys, sqlite3, cPickle
+from traceback import print_exc
+
+from ircbase import parseprefix, irc_lower, LazyLine
+from channellog import ChannelFilter, parse_logline, read_range, time_key
+from channellog import find_new_chunks
+from logindex import ALL_CHANNELS, write_snapshots
+from logsegments import open_log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY, -- in the order of the logs
+    time TEXT, timekey TEXT, nick TEXT, cmd TEXT, linestr TEXT);
+CREATE TABLE IF NOT EXISTS line_channels (
+    line INTEGER, channel TEXT, day TEXT);
+CREATE TABLE IF NOT EXISTS snapshots (
+    channel TEXT, day TEXT, line INTEGER, state BLOB,
+    PRIMARY KEY (channel, day));
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB);
+CREATE INDEX IF NOT EXISTS line_channels_channel_day
+    ON line_channels (channel, day, line);
+CREATE INDEX IF NOT EXISTS lines_nick_timekey ON lines (nick, timekey);
+-- the ids of the messages in the URIs are their times:
+CREATE INDEX IF NOT EXISTS lines_timekey ON lines (timekey);
+"""
+
+def connect(dbname):
+    db = sqlite3.connect(dbname)
+    db.text_factory = str # the logs aren't always UTF-8
+    db.executescript(SCHEMA)
+    return db
+
+class DatabaseWriter(object):
+    """Adds the lines of the logs to a database, replaying them in the
+    tracker, a ChannelFilter. Works like IndexWriter in logindex.py."""
+    def __init__(self, db, tracker, day):
+        self.db = db
+        self.tracker = tracker
+        self.day = day # of the latest line
+        self.nextid = db.execute("SELECT max(id) FROM lines").fetchone()[0]
+        self.nextid = (self.nextid or 0) + 1
+
+    def add_lines(self, name, lines):
+        rows = []
+        channelrows = []
+        for i, l in enumerate(lines):
+            try:
+                line = parse_logline(l)
+                if line.ztime and not line.ztime.startswith(self.day or "-"):
+                    self.day = line.ztime.split("T")[0]
+                    write_snapshots(self, self.tracker, self.day, self.nextid)
+                channels = self.tracker.track(line) or []
+                if line.cmd == "001": # RPL_WELCOME resets the state
+                    channels = [ALL_CHANNELS]
+                nick = line.prefix and parseprefix(line.prefix)[0]
+            except:
+                print_exc()
+                print >>sys.stderr, "... on %s:%s: %s" % (name, i+1, l)
+                continue
+            # compared like the times in the logs, see time_key():
+            rows.append((self.nextid, line.time,
+                         line.ztime and time_key(line.ztime),
+                         nick and irc_lower(nick), line.cmd, line.linestr))
+            if line.ztime:
+                channelrows += [(self.nextid, channel, self.day)
+                                for channel in channels]
+            self.nextid += 1
+        self.db.executemany("INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?)",
+                            rows)
+        self.db.executemany("INSERT INTO line_channels VALUES (?, ?, ?)",
+                            channelrows)
+
+    def add_snapshot(self, day, channel, start, snapshot):
+        self.db.execute("INSERT OR IGNORE INTO snapshots VALUES (?, ?, ?, ?)",
+                        (channel, day, start,
+                         sqlite3.Binary(cPickle.dumps(snapshot, 2))))
+
+def load_state(db):
+    row = db.execute("SELECT value FROM state WHERE key = 'state'").fetchone()
+    if row is None:
+        return None
+    return cPickle.loads(str(row[0]))
+
+def save_state(db, state):
+    db.execute("INSERT OR REPLACE INTO state VALUES ('state', ?)",
+               (sqlite3.Binary(cPickle.dumps(state, 2)),))
+
+def load_logs(dbname, logfiles):
+    """Adds the complete lines appended to the log files since the last
+    time to the database, or all of them if a log has been truncated"""
+    db = connect(dbname)
+    try:
+        offsets, tracker, day = load_state(db) or ({}, None, None)
+        found = find_new_chunks(logfiles, offsets)
+        if found is None: # a log was truncated, start over
+            for table in ["lines", "line_channels", "snapshots", "state"]:
+                db.execute("DELETE FROM %s" % table)
+            tracker = day = None
+            found = find_new_chunks(logfiles, {})
+        chunks, offsets = found
+
+        writer = DatabaseWriter(db, tracker or ChannelFilter(None, None), day)
+        for name, start, end in chunks:
+            with open_log(name) as source:
+                writer.add_lines("%s@%d" % (name, start),
+                                 read_range(source, start, end))
+        save_state(db, (offsets, writer.tracker, writer.day))
+        db.commit()
+    finally:
+        db.close()
+
+class Database(object):
+    """A database written by load_logs(), as a source of lines for run()"""
+    def __init__(self, dbname):
+        self.name = dbname
+        self.db = sqlite3.connect(dbname)
+        self.db.text_factory = str
+
+    def find_snapshot(self, channel, timeprefix):
+        """Returns the first line of the first day of the time prefix, or
+        the latest day before it, with the client state and the channel
+        state at its start, or None"""
+        dayprefix = timeprefix[:len("YYYY-MM-DD")]
+        row = self.db.execute("""SELECT min(day) FROM snapshots
+                                 WHERE channel = ? AND day >= ? AND day < ?""",
+                              (ALL_CHANNELS, dayprefix,
+                               dayprefix + "~")).fetchone()
+        if row[0] is None:
+            row = self.db.execute("""SELECT max(day) FROM snapshots
+                                     WHERE channel = ? AND day < ?""",
+                                  (ALL_CHANNELS, dayprefix)).fetchone()
+        if row[0] is None:
+            return None
+        day = row[0]
+        start, clientstate = self.db.execute(
+            "SELECT line, state FROM snapshots WHERE channel = ? AND day = ?",
+            (ALL_CHANNELS, day)).fetchone()
+        channelstate = self.db.execute(
+            "SELECT state FROM snapshots WHERE channel = ? AND day = ?",
+            (channel, day)).fetchone()
+        return (day, start, cPickle.loads(str(clientstate)),
+                channelstate and cPickle.loads(str(channelstate[0])))
+
+    def find_lines(self, channel=None, timeprefix=None, since=None,
+                   until=None, nick=None, keepstate=False,
+                   newest_first=False):
+        """Returns the snapshot (client state, channel state) of the channel
+        to seed the pipeline with, or None, and the lines of the channel
+        and the nick between the times since and until. The arguments are
+        the same as in run(), where the time prefix is already included
+        in the times, or in run_tail() with newest_first."""
+        conditions, params = [], []
+        firstday = lastday = None
+        snapshot = None
+        if channel:
+            channel = irc_lower(channel)
+            if timeprefix:
+                snapshot = self.find_snapshot(channel, timeprefix)
+        if snapshot is not None:
+            firstday, start, clientstate, channelstate = snapshot
+            snapshot = clientstate, channelstate
+            conditions.append("id >= ?")
+            params.append(start)
+        elif since and not keepstate:
+            firstday = time_key(since)[:len("YYYY-MM-DD")]
+            conditions.append("timekey >= ?")
+            params.append(time_key(since))
+        if until:
+            lastday = time_key(until)[:len("YYYY-MM-DD")]
+            conditions.append("timekey < ?")
+            params.append(time_key(until))
+        if channel:
+            conditions.append("""id IN (SELECT line FROM line_channels
+                                        WHERE channel IN (?, ?)
+                                        AND day >= ? AND day <= ?)""")
+            params += [channel, ALL_CHANNELS, firstday or "", lastday or "~"]
+        if nick:
+            conditions.append("nick = ?")
+            params.append(irc_lower(nick))
+
+        query = "SELECT linestr, time FROM lines"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id" + (" DESC" if newest_first else "")
+        rows = self.db.execute(query, params)
+        return snapshot, (LazyLine(linestr, time) for linestr, time in rows)
+
+    def close(self):
+        self.db.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print >>sys.stderr, "Usage: %s database logfile..." % sys.argv[0]
+        sys.exit(5)
+    load_logs(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+"""logindex.py - a module for indexing the logs by day and channel
+
+An index is kept in a sidecar file next to each log file (e.g.
+freenode.log.idx) and maps the days and channels to the byte ranges of
+the log file where their lines are. run() in channellog.py uses it to
+read only the relevant parts of a log.
+
+The state of the channels at the start of each day is kept in another
+sidecar file (e.g. freenode.log.123456.snapshots for the log indexed up
+to byte 123456), so that ChannelFilter can start from the middle of the
+log.
+
+A summary of each segment of about 4 MB of a log is kept in a third
+sidecar file (e.g. freenode.log.summary): the first and the last time,
+the channels and a Bloom filter of the nicks in the segment, so that
+run() can skip the segments that can't have lines of a channel or a
+nick. The summaries are updated incrementally as the log grows.
+
+Usage (the log files in order, oldest first):
+logindex.py freenode.log.2008 freenode.log
+
+Example usage:
+from logindex import find_ranges
+ranges = find_ranges("freenode.log", "#sioc", "2009-09-01")
+"""
+
+from __future__ import with_statement
+
+import sys, os, hashlib, cPickle
+from traceback import print_exc
+
+from ircbase import parseprefix, irc_lower
+from logsegments import open_log, seekable, log_size
+
+INDEX_SUFFIX = ".idx"
+SNAPSHOTS_SUFFIX = ".snapshots"
+INDEX_HEADER = "# sioclog index v2" # v2: channels in RFC 1459 lower case
+
+ALL_CHANNELS = "*" # lines that concern the state of every channel
+NO_CHANNEL = "-" # lines that are not related to any channel
+
+# lines closer than this are kept in the same range:
+MAX_GAP = 4096
+
+SUMMARY_SUFFIX = ".summary"
+SUMMARY_STATE_SUFFIX = ".summary.state"
+SUMMARY_HEADER = "# sioclog summary v1"
+SEGMENT_SIZE = 4*1024*1024
+BLOOM_BITS = 4096 # false positives for 1 in about 30 nicks with 500 nicks
+BLOOM_HASHES = 3
+
+def index_name(logname):
+    return logname + INDEX_SUFFIX
+
+def snapshots_name(logname, size):
+    return "%s.%d%s" % (logname, size, SNAPSHOTS_SUFFIX)
+
+def file_id(f):
+    """Returns the inode and the size of an open log"""
+    return os.fstat(f.fileno()).st_ino, log_size(f)
+
+class IndexWriter(object):
+    """Collects the byte ranges of the lines of a log file by day and
+    channel and the snapshots of the channel state at the start of each
+    day, and writes them into an index file and a snapshots file"""
+    def __init__(self, snapshots):
+        self.ranges = {} # (day, channel) -> [[start, end], ...]
+        self.snapshots = snapshots # the file to write the snapshots in
+        # (day, channel) -> (start of the day, offset in snapshots):
+        self.snapshot_offsets = {}
+        self.latest = {} # channel -> (snapshot, offset in snapshots)
+
+    def add(self, day, channel, start, end):
+        ranges = self.ranges.setdefault((day, channel), [])
+        if ranges and start - ranges[-1][1] <= MAX_GAP:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+
+    def add_snapshot(self, day, channel, start, snapshot):
+        if (day, channel) in self.snapshot_offsets:
+            return
+        if channel in self.latest and self.latest[channel][0] == snapshot:
+            offset = self.latest[channel][1] # unchanged since
+        else:
+            offset = self.snapshots.tell()
+            cPickle.dump(snapshot, self.snapshots, 2)
+            self.latest[channel] = snapshot, offset
+        self.snapshot_offsets[(day, channel)] = start, offset
+
+    def write(self, f, inode, size):
+        print >>f, "%s %d %d" % (INDEX_HEADER, inode, size)
+        for (day, channel), ranges in sorted(self.ranges.items()):
+            for start, end in ranges:
+                print >>f, "%s %s %d %d" % (day, channel, start, end)
+        for (day, channel), (start, offset) in \
+                sorted(self.snapshot_offsets.items()):
+            print >>f, "%s %s = %d %d" % (day, channel, start, offset)
+
+def read_index(logname, inode, size):
+    """Returns the ranges, the snapshot offsets and the indexed size from
+    the index of a log file, or None if there is no index or it doesn't
+    match the log"""
+    try:
+        f = file(index_name(logname))
+    except IOError:
+        return None
+    with f:
+        header = f.readline().split()
+        if " ".join(header[:-2]) != INDEX_HEADER:
+            return None
+        indexed_inode, indexed_size = map(int, header[-2:])
+        if indexed_inode != inode or indexed_size > size:
+            return None # the log has been replaced
+        index = {}
+        snapshots = {}
+        for l in f:
+            fields = l.split()
+            if len(fields) == 5: # day channel = start offset
+                day, channel, _, start, offset = fields
+                snapshots[(day, channel)] = int(start), int(offset)
+            else:
+                day, channel, start, end = fields
+                index.setdefault((day, channel), []).append((int(start),
+                                                             int(end)))
+    return index, snapshots, indexed_size
+
+def read_snapshot(logname, size, offset):
+    with file(snapshots_name(logname, size), "rb") as f:
+        f.seek(offset)
+        return cPickle.load(f)
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+def find_ranges(source, channel=None, timeprefix=None):
+    """Returns the sorted byte ranges of an open log file that can contain
+    lines of a channel on days matching a time prefix, and a snapshot, or
+    None if the whole file needs to be read. The end of the last range is
+    None if the log has grown since it was indexed.
+
+    If both a channel and a time prefix are given, the snapshot is a tuple
+    (client state, channel state) of the channel at the start of the first
+    range, from where all the lines related to the channel are included.
+    Otherwise, it is None."""
+    inode, size = file_id(source)
+    found = read_index(source.name, inode, size)
+    if found is None:
+        return None
+    index, snapshots, indexed_size = found
+
+    dayprefix = (timeprefix or "")[:len("YYYY-MM-DD")]
+    if channel:
+        channel = irc_lower(channel)
+        channels = (channel, ALL_CHANNELS)
+    else:
+        channels = None # all
+
+    snapshot = None
+    firstday = dayprefix
+    if channel and timeprefix:
+        # start from the first day of the time prefix, or the latest day
+        # before it if it hasn't been indexed:
+        days = [day for day, c in snapshots if c == ALL_CHANNELS]
+        matching = [day for day in days if day.startswith(dayprefix)]
+        before = [day for day in days if day < dayprefix]
+        if matching or before:
+            firstday = min(matching) if matching else max(before)
+            start, offset = snapshots[(firstday, ALL_CHANNELS)]
+            try:
+                clientstate = read_snapshot(source.name, indexed_size, offset)
+                channelstate = None
+                if (firstday, channel) in snapshots:
+                    _, offset = snapshots[(firstday, channel)]
+                    channelstate = read_snapshot(source.name, indexed_size,
+                                                 offset)
+            except IOError: # the index was replaced meanwhile
+                return None
+            snapshot = start, clientstate, channelstate
+
+    ranges = []
+    for (day, c), dayranges in index.iteritems():
+        if channels is not None and c not in channels:
+            continue
+        if day.startswith(dayprefix) or firstday <= day < dayprefix:
+            ranges += dayranges
+    ranges = merge_ranges(ranges)
+
+    if size > indexed_size:
+        ranges.append((indexed_size, None))
+    return ranges, snapshot
+
+def index_log(source, tracker, writer):
+    """Replays the lines of a log file in the tracker, a ChannelFilter, and
+    adds them to the index writer. Returns the size of the indexed part."""
+    from channellog import parse_logline
+
+    offset = 0
+    day = None
+    for l in iter(source.readline, ""):
+        if not l.endswith("\n"):
+            break # the line is still being written
+        start, offset = offset, offset + len(l)
+        try:
+            line = parse_logline(l)
+            if line.ztime and not line.ztime.startswith(day or "-"):
+                day = line.ztime.split("T")[0]
+                write_snapshots(writer, tracker, day, start)
+            channels = tracker.track(line) or [NO_CHANNEL]
+            if line.cmd == "001": # RPL_WELCOME resets the state
+                channels = [ALL_CHANNELS]
+        except:
+            print_exc()
+            print >>sys.stderr, "... on %s@%d: %s" % (source.name, start, l)
+            continue
+        if not line.ztime:
+            continue
+        for channel in channels:
+            writer.add(day, channel, start, offset)
+    return offset
+
+def replay_log(source, tracker):
+    """Replays the lines of a log file in the tracker without indexing"""
+    from channellog import parse_logline
+
+    for l in source:
+        try:
+            tracker.track(parse_logline(l))
+        except:
+            print_exc()
+            print >>sys.stderr, "... on %s: %s" % (source.name, l)
+
+def write_snapshots(writer, tracker, day, start):
+    writer.add_snapshot(day, ALL_CHANNELS, start, tracker.client_state())
+    for channel in tracker.members.channels():
+        writer.add_snapshot(day, channel, start,
+                            tracker.channel_state(channel))
+
+def remove_old_snapshots(logname, size):
+    dirname, basename = os.path.split(logname)
+    for name in os.listdir(dirname or "."):
+        if (name.startswith(basename + ".") and
+            name.endswith(SNAPSHOTS_SUFFIX) and
+            name[len(basename)+1:-len(SNAPSHOTS_SUFFIX)].isdigit() and
+            os.path.join(dirname, name) != snapshots_name(logname, size)):
+            os.remove(os.path.join(dirname, name))
+
+class Summary(object):
+    """The times, channels and nicks of the lines of a segment of a log"""
+    def __init__(self, start, end=None, first=None, last=None, channels=(),
+                 bloom=0):
+        self.start = start
+        self.end = end or start
+        self.first = first # the UTC time keys of the first and last lines
+        self.last = last
+        self.channels = set(channels) # as related by a ChannelFilter
+        self.bloom = bloom # of the nicks of the prefixes in lower case
+
+    def add(self, line, channels, end):
+        self.end = end
+        if line.ztime:
+            timekey = line.ztime.rstrip("Z")
+            self.first = min(self.first or timekey, timekey)
+            self.last = max(self.last or timekey, timekey)
+        self.channels.update(channels)
+        nick, _ = parseprefix(line.prefix or "")
+        if nick:
+            for bit in bloom_bits(nick):
+                self.bloom |= 1 << bit
+
+    def may_contain(self, channel=None, nick=None, since=None, until=None):
+        """Tells whether the segment may have lines of the channel (or
+        ones that affect all channels), from the nick and between the time
+        keys since and until"""
+        if channel and not (irc_lower(channel) in self.channels or
+                            ALL_CHANNELS in self.channels):
+            return False
+        if nick and not all(self.bloom >> bit & 1 for bit in bloom_bits(nick)):
+            return False
+        if since and not (self.last and self.last >= since):
+            return False
+        if until and not (self.first and self.first < until):
+            return False
+        return True
+
+    def __str__(self):
+        return "%d %d %s %s %s %x" % (self.start, self.end, self.first or "-",
+                                      self.last or "-",
+                                      ",".join(sorted(self.channels)) or "-",
+                                      self.bloom)
+
+def parse_summary(l):
+    start, end, first, last, channels, bloom = l.split()
+    return Summary(int(start), int(end), first.strip("-") or None,
+                   last.strip("-") or None,
+                   [c for c in channels.split(",") if c != "-"],
+                   int(bloom, 16))
+
+def bloom_bits(nick):
+    digest = hashlib.md5(irc_lower(nick)).hexdigest()
+    return [int(digest[i*8:i*8+8], 16) % BLOOM_BITS
+            for i in range(BLOOM_HASHES)]
+
+def read_summaries(logname, inode, size):
+    """Returns the summaries of the segments of a log file and the size of
+    the summarized part, or None if there are none or they don't match
+    the log"""
+    try:
+        f = file(logname + SUMMARY_SUFFIX)
+    except IOError:
+        return None
+    with f:
+        header = f.readline().split()
+        if " ".join(header[:-2]) != SUMMARY_HEADER:
+            return None
+        summarized_inode, summarized_size = map(int, header[-2:])
+        if summarized_inode != inode or summarized_size > size:
+            return None # the log has been replaced
+        return [parse_summary(l) for l in f], summarized_size
+
+def find_segments(source, channel=None, nick=None, since=None, until=None):
+    """Returns the sorted byte ranges of the segments of an open log file
+    that may have lines of the channel, from the nick and between the time
+    keys since and until, or None if the log hasn't been summarized. The
+    end of the last range is None if the log has grown since."""
+    inode, size = file_id(source)
+    found = read_summaries(source.name, inode, size)
+    if found is None:
+        return None
+    summaries, summarized_size = found
+    ranges = []
+    for summary in summaries:
+        if summary.may_contain(channel, nick, since, until):
+            if ranges and ranges[-1][1] == summary.start:
+                ranges[-1] = ranges[-1][0], summary.end
+            else:
+                ranges.append((summary.start, summary.end))
+    if size > summarized_size:
+        ranges.append((summarized_size, None))
+    return ranges
+
+def summarize_log(source, tracker, summaries, start):
+    """Replays the lines of a log file from the start offset in the tracker,
+    a ChannelFilter, and adds them to the summaries, continuing the last
+    one if it is shorter than SEGMENT_SIZE. Returns the size of the
+    summarized part."""
+    from channellog import parse_logline
+
+    if summaries and summaries[-1].end - summaries[-1].start < SEGMENT_SIZE:
+        summary = summaries[-1]
+    else:
+        summary = Summary(start)
+        summaries.append(summary)
+    offset = start
+    source.seek(start)
+    for l in iter(source.readline, ""):
+        if not l.endswith("\n"):
+            break # the line is still being written
+        if offset - summary.start >= SEGMENT_SIZE:
+            summary = Summary(offset)
+            summaries.append(summary)
+        offset += len(l)
+        try:
+            line = parse_logline(l)
+            channels = tracker.track(line)
+            if line.cmd == "001": # RPL_WELCOME resets the state
+                channels = [ALL_CHANNELS]
+            summary.add(line, channels, offset)
+        except:
+            print_exc()
+            print >>sys.stderr, "... on %s@%d: %s" % (source.name,
+                                                      offset - len(l), l)
+            summary.end = offset
+    if summary.end == summary.start:
+        summaries.pop() # nothing new
+    return offset
+
+def update_summaries(logfiles):
+    """Updates the summaries of the log files with the lines appended since,
+    replaying the channel state through all of them like build_indexes()"""
+    from channellog import ChannelFilter
+
+    tracker = ChannelFilter(None, None)
+    for logname in logfiles:
+        with open_log(logname) as source:
+            if not seekable(source): # compressed, always read as a whole
+                replay_log(source, tracker)
+                continue
+            inode, size = file_id(source)
+            summaries, start = [], 0
+            found = read_summaries(logname, inode, size)
+            if found is not None:
+                try: # the state of the tracker at the end of the summaries
+                    with file(logname + SUMMARY_STATE_SUFFIX, "rb") as f:
+                        summarized_size, summarized_tracker = cPickle.load(f)
+                    if summarized_size == found[1]:
+                        summaries, start = found
+                        tracker = summarized_tracker
+                except (IOError, EOFError, cPickle.UnpicklingError):
+                    pass # summarize the whole log again
+            size = summarize_log(source, tracker, summaries, start)
+
+        tmpname = "%s.%d.tmp" % (logname, os.getpid())
+        with file(tmpname, "wb") as f:
+            cPickle.dump((size, tracker), f, 2)
+        os.rename(tmpname, logname + SUMMARY_STATE_SUFFIX)
+        with file(tmpname, "w") as f:
+            print >>f, "%s %d %d" % (SUMMARY_HEADER, inode, size)
+            for summary in summaries:
+                print >>f, summary
+        os.rename(tmpname, logname + SUMMARY_SUFFIX)
+
+def build_indexes(logfiles):
+    """Writes an index for each of the log files, replaying the channel
+    state through all of them to relate NICKs and QUITs to channels"""
+    from channellog import ChannelFilter
+
+    tracker = ChannelFilter(None, None)
+    for logname in logfiles:
+        with open_log(logname) as source:
+            if not seekable(source): # compressed, always read as a whole
+                replay_log(source, tracker)
+                continue
+        tmpname = "%s.%d.tmp" % (logname, os.getpid())
+        with file(tmpname, "wb") as snapshots:
+            writer = IndexWriter(snapshots)
+            with open_log(logname) as source:
+                inode, _ = file_id(source)
+                size = index_log(source, tracker, writer)
+        os.rename(tmpname, snapshots_name(logname, size))
+
+        # replace the old index atomically, it may be in use:
+        with file(tmpname, "w") as f:
+            writer.write(f, inode, size)
+        os.rename(tmpname, index_name(logname))
+        remove_old_snapshots(logname, size)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print >>sys.stderr, "Usage: %s logfile..." % sys.argv[0]
+        sys.exit(5)
+    build_indexes(sys.argv[1:])
+    update_summaries(sys.argv[1:])
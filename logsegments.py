@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+"""logsegments.py - a module for storing old logs compressed
+
+Logs that are no longer written can be compressed with gzip, bzip2 or xz
+(if the lzma module is available) and read as such, but only from the
+start to the end. To keep reading only the parts of a log that are
+needed, e.g. with an index (see logindex.py), a log can instead be
+converted into a block segment (e.g. freenode.log.2008.blocks), where
+the log is compressed in blocks of whole lines, with a table of the
+blocks at the end. Its offsets are the same as in the log, and only the
+blocks that are read are decompressed.
+
+A compact segment (e.g. freenode.log.2008.compact) is a block segment
+where the timestamps are stored as seconds since the epoch and the
+prefixes, commands, channels and timezones as numbers in dictionaries,
+which makes it several times smaller still. The lines are restored
+exactly as they were.
+
+Usage (writes freenode.log.2008.blocks or .compact, index it with
+logindex.py):
+logsegments.py [--compact] freenode.log.2008
+
+Example usage:
+from logsegments import open_log
+for l in open_log("freenode.log.2008.blocks"):
+    ...
+"""
+
+from __future__ import with_statement
+
+import sys, os, re, time, calendar, struct, array, marshal, zlib, gzip, bz2
+from bisect import bisect_right
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None # no xz support
+
+BLOCKS_SUFFIX = ".blocks"
+BLOCKS_HEADER = "# sioclog blocks 1\n"
+BLOCK_SIZE = 256*1024 # of the log, before compression
+BLOCK_ENTRY = struct.Struct("!QQI") # start in the log, offset, length
+BLOCKS_TRAILER = struct.Struct("!QQI") # table offset, log size, blocks
+COMPACT_SUFFIX = ".compact"
+COMPACT_HEADER = "# sioclog compact 1\n"
+# ... and the offset and length of the dictionaries:
+COMPACT_TRAILER = struct.Struct("!QQIQI")
+
+class ArchiveFile(object):
+    """A compressed log file, read from the start to the end"""
+    def __init__(self, name, fileobj):
+        self.name = name
+        self.fileobj = fileobj
+
+    def __iter__(self):
+        return iter(self.fileobj)
+
+    def readline(self):
+        return self.fileobj.readline()
+
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+
+    def seek(self, offset):
+        self.fileobj.seek(offset) # slow, unless to the start
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class BlockFile(object):
+    """A block segment of a log, read like the log file"""
+    kind = "block segment"
+    header = BLOCKS_HEADER
+    trailer = BLOCKS_TRAILER
+
+    def __init__(self, name):
+        self.name = name
+        self.f = file(name, "rb")
+        if self.f.read(len(self.header)) != self.header:
+            self.f.close()
+            raise IOError("%s is not a %s" % (name, self.kind))
+        self.f.seek(-self.trailer.size, 2)
+        tableoffset, self.size, count = self.read_trailer(
+            self.trailer.unpack(self.f.read(self.trailer.size)))
+        self.f.seek(tableoffset)
+        table = self.f.read(count * BLOCK_ENTRY.size)
+        self.blocks = [BLOCK_ENTRY.unpack_from(table, i * BLOCK_ENTRY.size)
+                       for i in range(count)]
+        self.starts = [start for start, _, _ in self.blocks]
+        self.pos = 0
+        self.cached = None, None # the last block decompressed
+
+    def read_trailer(self, fields):
+        return fields
+
+    def decode(self, data):
+        """Returns the lines of a block as they are in the log"""
+        return zlib.decompress(data)
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def block(self, pos):
+        """Returns the start of the block at a position and its lines"""
+        i = bisect_right(self.starts, pos) - 1
+        if self.cached[0] != i:
+            start, offset, length = self.blocks[i]
+            self.f.seek(offset)
+            self.cached = i, self.decode(self.f.read(length))
+        return self.starts[i], self.cached[1]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(0, offset)
+
+    def tell(self):
+        return self.pos
+
+    def readline(self):
+        if self.pos >= self.size:
+            return ""
+        start, data = self.block(self.pos)
+        end = data.find("\n", self.pos - start) + 1 or len(data)
+        l = data[self.pos - start:end] # the blocks have whole lines
+        self.pos = start + end
+        return l
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size
+        parts = []
+        while size > 0 and self.pos < self.size:
+            start, data = self.block(self.pos)
+            part = data[self.pos - start:self.pos - start + size]
+            parts.append(part)
+            self.pos += len(part)
+            size -= len(part)
+        return "".join(parts)
+
+    def __iter__(self):
+        while self.pos < self.size:
+            start, data = self.block(self.pos)
+            lines = data[self.pos - start:].split("\n")
+            last = lines.pop()
+            for l in lines:
+                self.pos += len(l) + 1
+                yield l + "\n"
+            if last: # the last line of the log is incomplete
+                self.pos += len(last)
+                yield last
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class CompactFile(BlockFile):
+    """A compact segment of a log, read like the log file"""
+    kind = "compact segment"
+    header = COMPACT_HEADER
+    trailer = COMPACT_TRAILER
+
+    def read_trailer(self, fields):
+        tableoffset, size, count, dictoffset, dictlength = fields
+        self.f.seek(dictoffset)
+        (self.timezones, self.prefixes, self.cmds,
+         self.channels) = marshal.loads(zlib.decompress(
+                self.f.read(dictlength)))
+        self.offsets = map(timezone_offset, self.timezones)
+        self.hours = {} # local hour since the epoch -> "YYYY-MM-DDTHH"
+        return tableoffset, size, count
+
+    def decode(self, data):
+        columns = marshal.loads(zlib.decompress(data))
+        times, timezones, prefixes, cmds, channels = map(unpack_ints,
+                                                         columns[:5])
+        tails = columns[5].split("\n")
+        lines = []
+        append = lines.append
+        hours, offsets = self.hours, self.offsets
+        tznames, prefixnames, cmdnames, channelnames = \
+            self.timezones, self.prefixes, self.cmds, self.channels
+        epoch = 0
+        for t, tz, prefix, cmd, channel, tail in zip(times, timezones,
+                                                     prefixes, cmds,
+                                                     channels, tails):
+            if tz < 0: # a line that isn't encoded
+                append(tail + "\n" if tz == RAW_LINE else tail)
+                continue
+            epoch += t
+            local = epoch + offsets[tz]
+            try:
+                hour = hours[local // 3600]
+            except KeyError:
+                hour = hours[local // 3600] = format_hour(local)
+            append("%s%s%s %s%s%s%s\r\n" % (
+                    hour, MINUTES_SECONDS[local % 3600], tznames[tz],
+                    prefixnames[prefix], cmdnames[cmd], channelnames[channel],
+                    tail))
+        return "".join(lines)
+
+def open_log(name):
+    """Opens a log file, a compressed one or a segment for reading"""
+    if name.endswith(BLOCKS_SUFFIX):
+        return BlockFile(name)
+    elif name.endswith(COMPACT_SUFFIX):
+        return CompactFile(name)
+    elif name.endswith(".gz"):
+        return ArchiveFile(name, gzip.open(name))
+    elif name.endswith(".bz2"):
+        return ArchiveFile(name, bz2.BZ2File(name))
+    elif name.endswith(".xz"):
+        if lzma is None:
+            raise IOError("%s can't be read without an lzma module" % name)
+        return ArchiveFile(name, lzma.LZMAFile(name))
+    return file(name)
+
+def seekable(source):
+    """Tells whether parts of an open log can be read without reading the
+    whole log"""
+    if isinstance(source, BlockFile):
+        return True
+    return isinstance(source, file) and os.path.isfile(source.name)
+
+def log_size(source):
+    """Returns the size of a seekable open log"""
+    if isinstance(source, BlockFile):
+        return source.size
+    return os.fstat(source.fileno()).st_size
+
+class BlockWriter(object):
+    """Writes the lines of a log file into a block segment"""
+    header = BLOCKS_HEADER
+
+    def __init__(self, f):
+        self.f = f
+        self.table = []
+        self.size = 0 # of the log written so far
+        f.write(self.header)
+
+    def write(self, source):
+        block = []
+        blocksize = 0
+        for l in source:
+            block.append(l)
+            blocksize += len(l)
+            if blocksize >= BLOCK_SIZE:
+                self.write_block(block, blocksize)
+                block = []
+                blocksize = 0
+        if block:
+            self.write_block(block, blocksize)
+
+    def write_block(self, lines, blocksize):
+        data = self.encode(lines)
+        self.table.append((self.size, self.f.tell(), len(data)))
+        self.f.write(data)
+        self.size += blocksize
+
+    def encode(self, lines):
+        return zlib.compress("".join(lines), 9)
+
+    def close(self):
+        tableoffset = self.f.tell()
+        for entry in self.table:
+            self.f.write(BLOCK_ENTRY.pack(*entry))
+        self.write_trailer(tableoffset)
+
+    def write_trailer(self, tableoffset):
+        self.f.write(BLOCKS_TRAILER.pack(tableoffset, self.size,
+                                         len(self.table)))
+
+class CompactWriter(BlockWriter):
+    """Writes the lines of a log file into a compact segment"""
+    header = COMPACT_HEADER
+
+    def __init__(self, f):
+        BlockWriter.__init__(self, f)
+        # the id 0 is for no prefix or channel:
+        self.timezones, self.prefixes = Dictionary(), Dictionary([""])
+        self.cmds, self.channels = Dictionary(), Dictionary([""])
+
+    def encode(self, lines):
+        columns = times, timezones, prefixes, cmds, channels, tails = \
+            [], [], [], [], [], []
+        previous = 0
+        for l in lines:
+            fields = split_logline(l)
+            if fields is None:
+                times.append(0)
+                if l.endswith("\n"):
+                    timezones.append(RAW_LINE)
+                    tails.append(l[:-1])
+                else: # the incomplete last line of the log
+                    timezones.append(RAW_END)
+                    tails.append(l)
+                prefixes.append(0)
+                cmds.append(0)
+                channels.append(0)
+                continue
+            epoch, timezone, prefix, cmd, channel, tail = fields
+            times.append(epoch - previous)
+            previous = epoch
+            timezones.append(self.timezones.id(timezone))
+            prefixes.append(self.prefixes.id(prefix))
+            cmds.append(self.cmds.id(cmd))
+            channels.append(self.channels.id(channel))
+            tails.append(tail)
+        columns = map(pack_ints, columns[:5]) + ["\n".join(tails)]
+        return zlib.compress(marshal.dumps(tuple(columns), 2), 9)
+
+    def write_trailer(self, tableoffset):
+        dictoffset = self.f.tell()
+        data = zlib.compress(marshal.dumps((self.timezones.items,
+                                            self.prefixes.items,
+                                            self.cmds.items,
+                                            self.channels.items), 2), 9)
+        self.f.write(data)
+        self.f.write(COMPACT_TRAILER.pack(tableoffset, self.size,
+                                          len(self.table), dictoffset,
+                                          len(data)))
+
+RAW_LINE, RAW_END = -1, -2 # the timezones of the lines stored as such
+
+def pack_ints(ints):
+    a = array.array("i", ints)
+    if sys.byteorder == "big":
+        a.byteswap() # always little endian
+    return a.tostring()
+
+def unpack_ints(data):
+    a = array.array("i", data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+class Dictionary(object):
+    """Numbers the strings in the order they are first seen"""
+    def __init__(self, items=()):
+        self.items = list(items)
+        self.ids = dict((item, i) for i, item in enumerate(self.items))
+
+    def id(self, item):
+        try:
+            return self.ids[item]
+        except KeyError:
+            self.items.append(item)
+            self.ids[item] = len(self.items) - 1
+            return len(self.items) - 1
+
+timestampre = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)((\.\d+)?(Z|[+-]\d\d:\d\d))\Z")
+
+def timezone_offset(timezone):
+    """Returns the offset of a W3C timezone, after the fraction of a second
+    if any, from UTC in seconds"""
+    if timezone.endswith("Z"):
+        return 0
+    offset = int(timezone[-5:-3]) * 3600 + int(timezone[-2:]) * 60
+    return -offset if timezone[-6] == "-" else offset
+
+def format_hour(local):
+    return time.strftime("%Y-%m-%dT%H", time.gmtime(local - local % 3600))
+
+MINUTES_SECONDS = [":%02d:%02d" % divmod(i, 60) for i in range(3600)]
+
+def split_logline(l):
+    """Splits a line of a log file into the time in seconds since the epoch,
+    the fraction of a second and the timezone, the prefix (as ":prefix "),
+    the command, the channel (as " #channel") and the rest, or returns None
+    if the line can't be restored from them exactly"""
+    if not l.endswith("\r\n") or " " not in l:
+        return None
+    timestamp, linestr = l[:-2].split(" ", 1)
+    match = timestampre.match(timestamp)
+    if not match:
+        return None
+    timezone = match.group(7)
+    epoch = (calendar.timegm(map(int, match.groups()[:6])) -
+             timezone_offset(timezone))
+    local = epoch + timezone_offset(timezone)
+    if format_hour(local) + MINUTES_SECONDS[local % 3600] + timezone != \
+            timestamp: # e.g. a leap second
+        return None
+
+    prefix = ""
+    if linestr.startswith(":"):
+        if " " not in linestr:
+            return None
+        prefix, linestr = linestr.split(" ", 1)
+        prefix += " "
+    cmd, space, tail = linestr.partition(" ")
+    tail = space + tail
+    channel = tail[1:].split(" ", 1)[0]
+    if channel[:1] in ("#", "&", "!", "+"):
+        channel = " " + channel
+        tail = tail[len(channel):]
+    else:
+        channel = ""
+    return epoch, timezone, prefix, cmd, channel, tail
+
+def convert_log(logname, writerclass=BlockWriter, suffix=BLOCKS_SUFFIX):
+    """Writes a segment of a log file next to it"""
+    tmpname = "%s.%d.tmp" % (logname, os.getpid())
+    with open_log(logname) as source:
+        with file(tmpname, "wb") as f:
+            writer = writerclass(f)
+            writer.write(source)
+            writer.close()
+    os.rename(tmpname, logname + suffix)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    writerclass, suffix = BlockWriter, BLOCKS_SUFFIX
+    if args[:1] == ["--compact"]:
+        args = args[1:]
+        writerclass, suffix = CompactWriter, COMPACT_SUFFIX
+    if not args:
+        print >>sys.stderr, "Usage: %s [--compact] logfile..." % sys.argv[0]
+        sys.exit(5)
+    for logname in args:
+        convert_log(logname, writerclass, suffix)
@@ -17,4 +17,12 @@ logfiles = ["/home/sioclog/freenode.log.2008", "/home/sioclog/freenode.log"]
 # FIXME can't infer this from CGI info?
 rootURI = "http://irc.sioc-project.org/"
 
-runcgi(rootURI, logfiles)
+# change this to a directory writable by the HTTP server to keep the
+# results of processing the logs between requests, or None:
+cachedir = None
+
+# change this to point to a database loaded from the logs with logdb.py to
+# query it instead of reading the logs, or None:
+database = None
+
+runcgi(rootURI, logfiles, cachedir=cachedir, database=database)
@@ -11,14 +11,18 @@ import cgi, os
 
 from ircbase import w3c_timestamp, convert_timestamp_to_z
 
-from channellog import OffFilter, ChannelFilter, TimeFilter, HtmlSink, TurtleSink, RawSink, ChannelsAndDaysSink, run, AddLinksFilter, BackLogHtmlSink, ChannelMessageTailFilter, UserFilter, EventSink
+from channellog import OffFilter, ChannelFilter, TimeFilter, HtmlSink, TurtleSink, RawSink, ChannelsAndDaysSink, run, run_tail, run_parallel, run_resumable, compile_pipeline, TeeFilter, AddLinksFilter, BackLogHtmlSink, BackLogStartSink, ChannelMessageTailFilter, LatestMessagesSink, UserFilter, EventSink
 from templating import new_context, get_template, expand_template
 from turtle import PlainLiteral, TypedLiteral, TurtleWriter
 from vocabulary import namespaces, RDF, RDFS, OWL, DC, DCTERMS, XSD, FOAF, SIOC, SIOCT, DS
+from logdb import Database
 from users import render_user, render_user_index, get_nick2people
 from styles import css_stylesheet
 
-def runcgi(datarooturi, logfiles):
+def runcgi(datarooturi, logfiles, processes=None, cachedir=None,
+           database=None):
+    if database:
+        logfiles = [Database(database)] # loaded from the logs with logdb.py
 
     HTTP_HOST = os.environ.get('HTTP_HOST', "")
     SERVER_PORT = os.environ.get('SERVER_PORT', "")
@@ -38,8 +42,7 @@ def runcgi(datarooturi, logfiles):
         return
     elif PATH_INFO == "/sitemap.xml":
         print "Content-type: text/xml"
-        sink = ChannelsAndDaysSink()
-        run(logfiles, sink)
+        sink = channels_and_days(logfiles, processes, cachedir)
         sitemap_index(sink, datarooturi)
         return
 
@@ -114,20 +117,29 @@ def runcgi(datarooturi, logfiles):
         print
 
     if restype == "users" and channel:
-        sink = ChannelsAndDaysSink()
-        run(logfiles, sink)
-
         latestsink = EventSink(datarooturi, None, None, datauri)
-        latestpipeline = OffFilter(UserFilter(channel, ChannelMessageTailFilter(1, AddLinksFilter(latestsink))))
-        run(logfiles, latestpipeline)
+        if cachedir and not database:
+            # only the new lines are read for the channels and days
+            sink = channels_and_days(logfiles, processes, cachedir)
+            # and for the latest messages
+            latestpipeline = AddLinksFilter(latestsink)
+            for line in latest_messages(logfiles, processes, cachedir).nick_messages(channel):
+                latestpipeline.handleReceived(line)
+            latestpipeline.close()
+        else:
+            latestpipeline = OffFilter(UserFilter(channel, ChannelMessageTailFilter(1, AddLinksFilter(latestsink))))
+            # read the lines that can be of the nick once for both, the
+            # sink is only asked about the nick
+            sink = ChannelsAndDaysSink()
+            run(logfiles, TeeFilter([sink, latestpipeline]), nick=channel)
 
         render_user(sink, format, crumbs, datarooturi, channel, datauri, latestsink)
     elif restype == "users":
-        sink = ChannelsAndDaysSink()
-        run(logfiles, sink)
+        sink = channels_and_days(logfiles, processes, cachedir)
         render_user_index(sink, format, crumbs, datarooturi, datauri)
     elif channel and timeprefix:
         # show log
+        since = until = None
         if format == "html":
             if restype == "backlog":
                 # FIXME temporary hack to get the params right:
@@ -136,6 +148,12 @@ def runcgi(datarooturi, logfiles):
                 timeprefix = nick
                 sink = AddLinksFilter(BackLogHtmlSink(nick, up_to, crumbs, datarooturi, channel, timeprefix, datauri))
                 timeprefix = ""
+                until = up_to
+                # find where the backlog starts from the end of the log
+                start = BackLogStartSink(nick, '#'+channel, up_to)
+                run_tail(logfiles, OffFilter(start), '#'+channel,
+                         until=up_to)
+                since = start.since
             else:
                 sink = AddLinksFilter(HtmlSink(crumbs, datarooturi, channel, timeprefix, datauri))
         elif format == "turtle":
@@ -143,26 +161,29 @@ def runcgi(datarooturi, logfiles):
         elif format == "raw":
             sink = RawSink()
 
-        pipeline = OffFilter(ChannelFilter('#'+channel,
+        pipeline = compile_pipeline(OffFilter(ChannelFilter('#'+channel,
                                            TimeFilter(timeprefix, 
                                                       sink
                                                       )
-                                           ))
+                                           )))
 
-        run(logfiles, pipeline)
+        # only messages are shown in html and turtle, no need for the
+        # channel state to relate NICKs and QUITs:
+        run(logfiles, pipeline, '#'+channel, timeprefix, since, until,
+            keepstate=format not in ("html", "turtle"))
 
     else:
         # show index
-        sink = ChannelsAndDaysSink()
-
         if channel:
-            pipeline = ChannelFilter('#'+channel, sink)
+            sink = ChannelsAndDaysSink()
+            pipeline = compile_pipeline(ChannelFilter('#'+channel, sink))
+            run(logfiles, pipeline, channel='#'+channel)
         elif timeprefix:
-            pipeline = TimeFilter(timeprefix, sink)
+            sink = ChannelsAndDaysSink()
+            pipeline = compile_pipeline(TimeFilter(timeprefix, sink))
+            run(logfiles, pipeline, timeprefix=timeprefix)
         else:
-            pipeline = sink
-
-        run(logfiles, pipeline)
+            sink = channels_and_days(logfiles, processes, cachedir)
 
         if format == "html":
             html_index(sink, crumbs, datarooturi, datauri, channel)
@@ -170,6 +191,26 @@ def runcgi(datarooturi, logfiles):
             turtle_index(sink, datarooturi, datauri, channel)
         # XXX more formats
 
+def channels_and_days(logfiles, processes, cachedir):
+    if isinstance(logfiles[0], Database):
+        sink = ChannelsAndDaysSink()
+        run(logfiles, sink)
+        return sink
+    elif cachedir:
+        checkpoint = os.path.join(cachedir, "channelsanddays.pickle")
+        return run_resumable(logfiles, ChannelsAndDaysSink, checkpoint,
+                             processes)
+    else:
+        return run_parallel(logfiles, ChannelsAndDaysSink, processes)
+
+def latest_messages_pipeline():
+    return OffFilter(LatestMessagesSink())
+
+def latest_messages(logfiles, processes, cachedir):
+    checkpoint = os.path.join(cachedir, "latestmessages.pickle")
+    return run_resumable(logfiles, latest_messages_pipeline, checkpoint,
+                         processes).sink
+
 def turtle_index(sink, root, datauri, querychannel):
     triples = []
 
@@ -208,7 +249,7 @@ def turtle_index(sink, root, datauri, querychannel):
                         (userURI, RDFS.label, PlainLiteral(nick)),
                         ]
 
-    writer = TurtleWriter(None, namespaces)
+    writer = TurtleWriter(None, namespaces, grouped=True)
     if querychannel and channels:
         title = "Index of #%s" % channels[0]
         writer.write([("", FOAF.primaryTopic, channelURIs[0])])
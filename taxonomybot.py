@@ -34,7 +34,7 @@ from twisted.web import http
 
 import ircbase
 ircbase.dbg = True
-from ircbase import parseprefix, Line, Irc
+from ircbase import parseprefix, Line, Irc, Membership
 
 import taxonomybot # XXX import myself for rebuild
 
@@ -61,7 +61,7 @@ class IrcServer(Irc):
         self.user = None # user@host
         self.serverprefix = None # irc.jyu.fi
         self.clientprefix = None # nick!user@host
-        self.channels = [] # the channels we are currently on
+        self.members = Membership() # the channels we are on, and who else
         self.away = False # whether we are currently marked as being away
         self.awaymsg = None # the away message we have last requested
 
@@ -120,6 +120,7 @@ class IrcServer(Irc):
         self.nick = line.args[0]
         _, self.user = parseprefix(line.args[-1].split(' ')[-1])
         self.clientprefix = "%s!%s" % (self.nick, self.user)
+        self.members.clear() # from previous connects
 
         if self.timeoutCall:
             self.timeoutCall.cancel()
@@ -203,9 +204,11 @@ class IrcServer(Irc):
     def irc_RPL_UMODEIS(self, line):
         return self.filter_oneline(self.modereq, line, argindex=0)
     def irc_RPL_NAMREPLY(self, line):
+        self.members.names(line.args[2], line.args[3].split(" "))
         return self.filter_dataline(self.namesreq, self.namesrep, line,
                                     argindex=2)
     def irc_RPL_ENDOFNAMES(self, line):
+        self.members.end_names(line.args[1])
         return self.filter_endline(self.namesreq, self.namesrep, line)
 
     # state tracking:
@@ -214,15 +217,23 @@ class IrcServer(Irc):
         if self.isme(line.prefix):
             self.nick = line.args[0]
             self.clientprefix = self.nick + '!' + self.user
+        self.members.rename(parseprefix(line.prefix)[0], line.args[0])
     def irc_JOIN(self, line):
         if self.isme(line.prefix):
-            self.channels.append(line.args[0])
+            self.members.leave(line.args[0])
+        self.members.join(parseprefix(line.prefix)[0], line.args[0])
     def irc_PART(self, line):
         if self.isme(line.prefix):
-            self.channels.remove(line.args[0])
+            self.members.leave(line.args[0])
+        else:
+            self.members.part(parseprefix(line.prefix)[0], line.args[0])
     def irc_KICK(self, line):
         if line.args[1] == self.nick:
-            self.channels.remove(line.args[0])
+            self.members.leave(line.args[0])
+        else:
+            self.members.part(line.args[1], line.args[0])
+    def irc_QUIT(self, line):
+        self.members.quit(parseprefix(line.prefix)[0])
     def irc_RPL_UNAWAY(self, _):
         self.away = False
     def irc_RPL_NOWAWAY(self, _):
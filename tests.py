@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""tests.py - a module for testing the pipelines on small logs
+
+Usage:
+tests.py
+"""
+
+import sys, os, re, tempfile, unittest
+from StringIO import StringIO
+
+from channellog import IrcSink, ChannelDemuxFilter, TaxonomySink, run
+from channellog import run_chunk, add_links
+from htmlutil import html_escape, html_unescape
+import logsegments
+from logdb import Database, load_logs
+
+LOG = """\
+2009-09-01T10:00:00+03:00 :irc.example 001 sioclog :Welcome to IRC
+2009-09-01T10:00:01+03:00 :sioclog!bot@host JOIN #sioc
+2009-09-01T10:00:01+03:00 :sioclog!bot@host JOIN #swig
+2009-09-01T10:00:02+03:00 :alice!u@h JOIN #sioc
+2009-09-01T10:00:03+03:00 :alice!u@h PRIVMSG #sioc :hello
+2009-09-01T10:00:04+03:00 :bob!u@h JOIN #swig
+2009-09-01T10:00:05+03:00 :bob!u@h PRIVMSG #swig :hi
+2009-09-01T10:00:06+03:00 :alice!u@h PRIVMSG sioclog :private
+2009-09-01T10:00:07+03:00 :alice!u@h NICK :alice_
+2009-09-01T10:00:08+03:00 :alice_!u@h PRIVMSG #sioc :again
+2009-09-01T10:00:09+03:00 :bob!u@h QUIT :bye
+"""
+
+class ListSink(IrcSink):
+    """A sink that keeps the lines it receives"""
+    def __init__(self):
+        IrcSink.__init__(self)
+        self.lines = []
+
+    def handleReceivedFallback(self, line):
+        self.lines.append(str(line))
+
+class IrcSinkTest(unittest.TestCase):
+    def test_merge(self):
+        self.assertRaises(TypeError, ListSink().merge, ListSink())
+
+class LogTestCase(unittest.TestCase):
+    log = LOG
+
+    def setUp(self):
+        fd, self.logname = tempfile.mkstemp(suffix=".log")
+        os.write(fd, self.log.replace("\n", "\r\n"))
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.logname)
+
+class ChannelDemuxFilterTest(LogTestCase):
+    def demux(self, batchsize):
+        sinks = {}
+        def create_sink(channel):
+            sinks[channel] = ListSink()
+            return sinks[channel]
+        run(self.logname, ChannelDemuxFilter(create_sink),
+            batchsize=batchsize)
+        return dict((channel, sink.lines)
+                    for channel, sink in sinks.iteritems())
+
+    def test_batches(self):
+        lines = self.demux(None)
+        self.assertEqual(sorted(lines), ["#sioc", "#swig"])
+        self.assertEqual(len(lines["#sioc"]), 5)
+        self.assertEqual(len(lines["#swig"]), 4)
+        for batchsize in [1, 3, 100]:
+            self.assertEqual(self.demux(batchsize), lines)
+
+# AddLinksFilter as it was before add_links(), which tried the forms of the
+# links in turn and stopped at the first one that matched:
+old_link_res = [
+  (r'&lt;(http(s)?://[^ ]*)&gt;',         r'&lt;<a href="\1">\1</a>&gt;'),
+(r'&quot;(http(s)?://[^ ]*)&quot;',     r'&quot;<a href="\1">\1</a>&quot;'),
+    (r'\[(http(s)?://[^ |]*)(\||\])',        r'[<a href="\1">\1</a>\3'),
+(r'(http(s)?://[^ ]*[^ ,.\1])[)](,? |$)',     r'<a href="\1">\1</a>)\3'),
+(r'(http(s)?://[^ ]*[^ ,.\1])',               r'<a href="\1">\1</a>'),
+(r'(^|[ (])(www\.[^ ]*[^ ,.\1])[)](,? |$)', r'\1<a href="http://\2">\2</a>)\3'),
+(r'(^|[ (])(www\.[^ ]*[^ ,.\1])',           r'\1<a href="http://\2">\2</a>'),
+]
+old_link_res = [(re.compile(link_re), sub) for (link_re, sub) in old_link_res]
+
+def old_add_links(content_html):
+    links = []
+    for link_re, sub in old_link_res:
+        content_html_sub = link_re.sub(sub, content_html)
+        if content_html_sub is not content_html:
+            for groups in link_re.findall(content_html):
+                if groups[1].startswith("www"):
+                    uri = "http://" + groups[1]
+                else:
+                    uri = groups[0]
+                links += [html_unescape(uri)]
+            break
+    return content_html_sub, links
+
+# messages with links of at most one form, linked the same as before:
+LINK_CORPUS = [
+    "hello",
+    "a & b <c> \"d\"",
+    "see http://example.org/a,b.",
+    "https://example.org/?a=1&b=2",
+    "two http://a.org/ http://b.org/x.",
+    "(www.example.com/foo), ok",
+    "www.example.com.",
+    "see (http://example.org/)",
+    "<http://example.org/a b>",
+    "\"https://example.org/\" it said",
+    "[http://example.org/|a label] and [http://example.net/]",
+    "http://",
+    "awww.example.com",
+]
+
+class AddLinksTest(unittest.TestCase):
+    def test_corpus(self):
+        for msg in LINK_CORPUS:
+            content_html = html_escape(msg)
+            self.assertEqual(add_links(content_html),
+                             old_add_links(content_html), msg)
+
+    def test_several_forms(self):
+        # the old filter only linked the first form that matched:
+        content_html = html_escape("(http://p.org/x) and http://q.org/")
+        self.assertEqual(old_add_links(content_html)[1], ["http://p.org/x"])
+        self.assertEqual(add_links(content_html), (
+            '(<a href="http://p.org/x">http://p.org/x</a>) and '
+            '<a href="http://q.org/">http://q.org/</a>',
+            ["http://p.org/x", "http://q.org/"]))
+        content_html = html_escape("<http://a.org/> www.b.org")
+        self.assertEqual(add_links(content_html)[1],
+                         ["http://a.org/", "http://www.b.org"])
+
+    def test_nested(self):
+        # the form leftmost in the message wins, not the first in the list:
+        content_html = html_escape("http://a<http://b>")
+        self.assertEqual(old_add_links(content_html)[1], ["http://b"])
+        self.assertEqual(add_links(content_html), (
+            '<a href="http://a&lt;http://b&gt;">http://a&lt;http://b&gt;</a>',
+            ["http://a<http://b>"]))
+
+class DatabaseTest(LogTestCase):
+    def setUp(self):
+        LogTestCase.setUp(self)
+        fd, self.dbname = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        load_logs(self.dbname, [self.logname])
+
+    def tearDown(self):
+        os.remove(self.dbname)
+        LogTestCase.tearDown(self)
+
+    def lines(self, source, **kwargs):
+        sink = ListSink()
+        run(source, sink, **kwargs)
+        return sink.lines
+
+    def test_fractional_times(self):
+        # the line at 07:00:03Z is between these:
+        times = dict(since="2009-09-01T07:00:02.5",
+                     until="2009-09-01T07:00:03.5")
+        db = Database(self.dbname)
+        try:
+            lines = self.lines(db, **times)
+        finally:
+            db.close()
+        self.assertEqual(lines, self.lines(self.logname, **times))
+        self.assertEqual(lines, [":alice!u@h PRIVMSG #sioc :hello"])
+
+# ends in the middle of a taxonomy response:
+TAXONOMY_LOG = """\
+2009-09-01T10:00:00+03:00 :NickServ!s@services NOTICE sioclog :You are now identified.
+2009-09-01T10:00:01+03:00 :NickServ!s@services NOTICE sioclog :Taxonomy for \x02alice\x02:
+2009-09-01T10:00:01+03:00 :NickServ!s@services NOTICE sioclog :url                      : http://example.org/
+2009-09-01T10:00:01+03:00 :NickServ!s@services NOTICE sioclog :End of \x02alice\x02 taxonomy.
+2009-09-01T10:00:02+03:00 :NickServ!s@services NOTICE sioclog :Taxonomy for \x02bob\x02:
+2009-09-01T10:00:02+03:00 :NickServ!s@services NOTICE sioclog :url                      : http://example.com/
+"""
+
+class TaxonomySinkTest(LogTestCase):
+    log = TAXONOMY_LOG
+
+    def test_ends_in_response(self):
+        sink = TaxonomySink()
+        run(self.logname, sink)
+        self.assertEqual(sink.taxonomy,
+                         {"alice": [("alice", "url", "http://example.org/")]})
+        self.assertEqual(sink.taxonomy_state, "bob")
+        self.assertEqual(sink.taxonomy_response,
+                         [("bob", "url", "http://example.com/")])
+
+# a response without an end that is split between two chunks:
+SPLIT_TAXONOMY_LOG = """\
+2009-09-01T10:00:01+03:00 :NickServ!s@services NOTICE sioclog :Taxonomy for \x02alice\x02:
+2009-09-01T10:00:01+03:00 :NickServ!s@services NOTICE sioclog :url                      : http://example.org/
+2009-09-01T10:00:01+03:00 :NickServ!s@services NOTICE sioclog :End of \x02alice\x02 taxonomy.
+2009-09-01T10:00:02+03:00 :NickServ!s@services NOTICE sioclog :Taxonomy for \x02bob\x02:
+2009-09-01T10:00:02+03:00 :NickServ!s@services NOTICE sioclog :url                      : http://example.com/
+2009-09-01T10:00:03+03:00 :NickServ!s@services NOTICE sioclog :email                    : bob@example.com
+2009-09-01T10:00:04+03:00 :NickServ!s@services NOTICE sioclog :You are now identified.
+2009-09-01T10:00:05+03:00 :NickServ!s@services NOTICE sioclog :Taxonomy for \x02carol\x02:
+2009-09-01T10:00:05+03:00 :NickServ!s@services NOTICE sioclog :url                      : http://example.net/
+2009-09-01T10:00:05+03:00 :NickServ!s@services NOTICE sioclog :End of \x02carol\x02 taxonomy.
+"""
+
+class TaxonomySinkMergeTest(LogTestCase):
+    log = SPLIT_TAXONOMY_LOG
+
+    def results(self, sink):
+        return sink.taxonomy, sink.taxonomy_state, sink.taxonomy_response
+
+    def test_split_response(self):
+        # the boundary after the first line of bob's response:
+        boundary = sum(len(l) + 2 for l in self.log.splitlines()[:5])
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            serial = TaxonomySink()
+            run(self.logname, serial)
+            serialerrors = sys.stderr.getvalue()
+            sys.stderr = StringIO()
+
+            merged = run_chunk((TaxonomySink, self.logname, 0, boundary))
+            merged.merge(run_chunk((TaxonomySink, self.logname, boundary,
+                                    None)))
+            merged.close()
+            mergederrors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(self.results(merged), self.results(serial))
+        self.assertEqual(sorted(serial.taxonomy), ["alice", "carol"])
+        self.assertTrue("You are now identified." in serialerrors)
+        self.assertTrue("You are now identified." in mergederrors)
+
+class OpenLogTest(unittest.TestCase):
+    def test_xz_without_lzma(self):
+        fd, name = tempfile.mkstemp(suffix=".log.xz")
+        os.close(fd)
+        lzma, logsegments.lzma = logsegments.lzma, None
+        try:
+            try:
+                logsegments.open_log(name).close()
+            except IOError, e:
+                self.assertTrue("lzma" in str(e))
+            else:
+                self.fail("%s was opened as a plain log" % name)
+        finally:
+            logsegments.lzma = lzma
+            os.remove(name)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,14 +7,34 @@ from turtle import PlainLiteral, TypedLiteral, TurtleWriter
 writer = TurtleWriter(self.base, namespaces)
 writer.write([(creator, RDFS.label, PlainLiteral(nick))])
 writer.close()
+
+With grouped=True, consecutive triples with the same subject are written
+as one statement, separated by ; or by , if the predicate is the same too.
 """
 
+import re
+
+# the characters escaped in strings and URIs, besides the end character:
+escapes = dict([(chr(c), '\\u%04x' % c) for c in range(0x20) + [0x7f]] +
+               [('\\', '\\\\'), ('\n', '\\n'), ('\r', '\\r'), ('\t', '\\t')])
+escape_res = {} # end character -> the characters to escape
+
+# the URIs shown are cached for each writer, as the same ones are repeated
+# in most of the triples (cleared when full):
+SHOWN_CACHE_SIZE = 4096
+
 class TurtleWriter(object):
-    def __init__(self, base=None, namespaces=None):
+    def __init__(self, base=None, namespaces=None, grouped=False):
+        self.grouped = grouped
+        self.statement = None # the last line of the open statement
+        self.subject = self.predicate = None # of the open statement
         if namespaces is not None:
             self.namespaces = namespaces
         else:
             self.namespaces = []
+        # the longest matching namespace is used:
+        self.prefixes = sorted(self.namespaces, key=lambda (ns, uri): -len(uri))
+        self.shown = {} # URI -> as shown
 
         print
 
@@ -26,13 +46,18 @@ class TurtleWriter(object):
         print
 
     def setBase(self, base):
+        self.end()
         self.base = base
+        self.shown = {}
         if self.base:
             print
             print "@base <%s> ." % (self.turtle_escape(">", self.base))
             print
 
     def write(self, triples):
+        if self.grouped:
+            self.write_grouped(triples)
+            return
         for t in triples:
             if not t:
                 print
@@ -40,36 +65,70 @@ class TurtleWriter(object):
                 s,p,o = t
                 print "%s %s %s ." % (self.show(s), self.show(p), self.show(o))
 
+    def write_grouped(self, triples):
+        # the last line of a statement is printed when it is known how it
+        # ends, so the statement can continue in the next call
+        for t in triples:
+            if not t:
+                self.end()
+                print
+                continue
+            s,p,o = t
+            if self.statement is None or s != self.subject:
+                self.end()
+                self.statement = "%s %s %s" % (self.show(s), self.show(p),
+                                               self.show(o))
+            elif p != self.predicate:
+                print self.statement + " ;"
+                self.statement = "    %s %s" % (self.show(p), self.show(o))
+            else:
+                print self.statement + " ,"
+                self.statement = "        %s" % self.show(o)
+            self.subject, self.predicate = s, p
+
+    def end(self):
+        """Ends the open statement of the grouped triples, if any"""
+        if self.statement is not None:
+            print self.statement + " ."
+            self.statement = None
+
     def close(self):
-        pass
+        self.end()
 
     def show(self, node):
         if isinstance(node, basestring): # URI
-            if self.base and node.startswith(self.base):
-                rest = node[len(self.base):]
-                if self.base.endswith("/") and not rest.startswith("/"):
-                    return "<" + self.turtle_escape(">", rest) + ">"
-                # XXX detect more cases where we can use a relative URI...
-            for ns, uri in self.namespaces:
-                if node.startswith(uri): # XXX and the rest is an allowed name
-                    return ns + ":" + node[len(uri):]
-            return "<" + self.turtle_escape(">", node) + ">"
+            shown = self.shown.get(node)
+            if shown is None:
+                if len(self.shown) >= SHOWN_CACHE_SIZE:
+                    self.shown.clear()
+                shown = self.shown[node] = self.show_uri(node)
+            return shown
         elif isinstance(node, PlainLiteral):
             return '"' + self.turtle_escape('"', node.text) + '"'
         elif isinstance(node, TypedLiteral):
             return '"' + self.turtle_escape('"', node.text) + '"' + "^^" + self.show(node.literaltype)
 
+    def show_uri(self, node):
+        if self.base and node.startswith(self.base):
+            rest = node[len(self.base):]
+            if self.base.endswith("/") and not rest.startswith("/"):
+                return "<" + self.turtle_escape(">", rest) + ">"
+            # XXX detect more cases where we can use a relative URI...
+        for ns, uri in self.prefixes:
+            if node.startswith(uri): # XXX and the rest is an allowed name
+                return ns + ":" + node[len(uri):]
+        return "<" + self.turtle_escape(">", node) + ">"
+
     def turtle_escape(self, endchar, text):
-        replacements = ([('\\', '\\\\'),
-                         (endchar, '\\'+endchar),
-                         ('\n', '\\n'),
-                         ('\r', '\\r'),
-                         ('\t', '\\t')] +
-                        [(chr(c), '\\u%04x' % c) for c in range(0x20)+[0x7f]]
-                        )
-        for char, escape in replacements:
-            text = text.replace(char, escape)
-        return text
+        escape_re = escape_res.get(endchar)
+        if escape_re is None:
+            escape_re = escape_res[endchar] = re.compile(
+                "[%s%s]" % (re.escape(endchar),
+                            "".join(map(re.escape, escapes))))
+        if escape_re.search(text) is None:
+            return text # nothing to escape, usually
+        return escape_re.sub(lambda m: escapes.get(m.group(0),
+                                                   "\\" + m.group(0)), text)
 
 class PlainLiteral:
     """RDF plain literal"""
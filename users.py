@@ -210,7 +210,7 @@ def render_user_index(sink, format, crumbs, datarooturi, datauri):
             if nick in nick2people:
                 triples += [(nick2people[nick], FOAF.holdsAccount, user)]
 
-        writer = TurtleWriter(None, namespaces)
+        writer = TurtleWriter(None, namespaces, grouped=True)
         title = "User index"
         writer.write([("", RDFS.label, PlainLiteral(title)),
                       ("", FOAF.primaryTopic, freenodeURI)])
@@ -297,7 +297,7 @@ def render_user(sink, format, crumbs, datarooturi, nick, datauri, latestsink):
                         (channelURI, SIOC.has_subscriber, userURI),
                         (channelURI, RDFS.label, PlainLiteral("#%s" % channel)),
                         ]
-        writer = TurtleWriter(None, namespaces)
+        writer = TurtleWriter(None, namespaces, grouped=True)
         title = "About user %s" % nick
         writer.write([("", RDFS.label, PlainLiteral(title)),
                       ("", FOAF.primaryTopic, userURI),